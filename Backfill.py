@@ -0,0 +1,215 @@
+import argparse
+import json
+import os
+import time
+from datetime import datetime
+from typing import Any, Optional
+from Email import Email
+from EmailAnalyzer import EmailAnalyzer
+from EmailRetriever import EmailRetriever
+from MySqlConnector import MySqlConnector
+from Metrics import InstrumentedRedis, timed_call
+from PendingBackfill import PendingBackfill
+from ResponseCache import ResponseCache
+from Secrets import Secrets
+
+SCOPES = ["https://www.googleapis.com/auth/gmail.readonly"]
+TERMINAL_BATCH_STATUSES = {'completed', 'failed', 'expired', 'cancelled'}
+
+
+class BackfillJob:
+    """
+    Classifies a user's whole backlog of unprioritized emails through the batch API instead of the synchronous
+    responses API, so it neither blocks nor competes with interactive refreshes.
+
+    Progress is checkpointed in <work_dir>/state.json after every step, so running the command again after a
+    crash resumes where it stopped:
+    1. prepare:  write the pending emails to a JSONL batch input file (plus their metadata)
+    2. submit:   upload the input file and create the batch
+    3. poll:     wait for the batch to finish
+    4. download: save the batch output file
+    5. apply:    stream the output back through sync_emails_to_db in chunks
+    """
+    def __init__(self, secrets: Secrets, credentials_json: str, work_dir: str, chunk_size: int = 500,
+                 poll_interval_seconds: float = 30, gmail_service: Any = None):
+        """
+        :param gmail_service: Gmail service to use instead of building one from the credentials (e.g. a local fake)
+        """
+        self.secrets = secrets
+        self.email_retriever = EmailRetriever(credentials_json, SCOPES, service=gmail_service)
+        self.username = self.email_retriever.retrieve_username()
+        # the batch endpoint is reached through the analyzer's client, so OPENAI_BASE_URL can point at a local stand-in
+        self.email_analyzer = EmailAnalyzer(secrets.openai_base_url, max_body_tokens=secrets.openai_max_body_tokens)
+        redis_client = InstrumentedRedis(host='localhost', port=6379, db=0, decode_responses=True)
+        self.response_cache = ResponseCache(redis_client)
+        # tells syncs which unprioritized emails the batch will classify, so they don't retry them meanwhile
+        self.pending_backfill = PendingBackfill(redis_client, MySqlConnector.get_schema_name(self.username))
+        self.work_dir = work_dir
+        self.chunk_size = chunk_size
+        self.poll_interval_seconds = poll_interval_seconds
+        os.makedirs(work_dir, exist_ok=True)
+        self.state = self.__load_state()
+
+    def run(self) -> None:
+        steps = [('prepared', self.prepare), ('submitted', self.submit), ('finished', self.poll),
+                 ('downloaded', self.download), ('applied', self.apply)]
+        for step_done, step in steps:
+            if not self.state.get(step_done):
+                step()
+            if self.state.get('email_count') == 0:
+                # the batch API rejects empty input files
+                print(f'Nothing to backfill for {self.username}')
+                return
+        print(f'Backfill of {self.username} complete')
+
+    def prepare(self) -> None:
+        with MySqlConnector(self.secrets.mysql_password, self.username) as mysql_connector:
+            gmail_ids = mysql_connector.get_gmail_ids_without_priority()
+        print(f'Writing {len(gmail_ids)} emails to the batch input file...')
+        email_count = 0
+        with open(self.__path('input.jsonl.tmp'), 'w') as input_file, open(self.__path('metadata.jsonl.tmp'), 'w') as metadata_file:
+            for email in self.email_retriever.retrieve_emails_by_id(gmail_ids):
+                email_count += 1
+                request = {'custom_id': email.gmail_id, 'method': 'POST', 'url': '/v1/responses',
+                           'body': self.email_analyzer.build_request(email)}
+                metadata = {'gmail_id': email.gmail_id, 'link': email.link, 'time_sent': email.time_sent.isoformat(),
+                            'sent_from': email.sent_from, 'subject': email.subject}
+                input_file.write(json.dumps(request) + '\n')
+                metadata_file.write(json.dumps(metadata) + '\n')
+        os.replace(self.__path('input.jsonl.tmp'), self.__path('input.jsonl'))
+        os.replace(self.__path('metadata.jsonl.tmp'), self.__path('metadata.jsonl'))
+        self.__save_state(prepared=True, email_count=email_count)
+
+    def submit(self) -> None:
+        client = self.email_analyzer.client
+        if not self.state.get('input_file_id'):
+            with open(self.__path('input.jsonl'), 'rb') as input_file:
+                with timed_call('openai', 'files.create'):
+                    uploaded = client.files.create(file=input_file, purpose='batch')
+            self.__save_state(input_file_id=uploaded.id)
+        # a previous run may have created the batch and crashed before saving its id
+        batch = self.__find_batch(self.state['input_file_id']) if self.state.get('submitting') else None
+        if batch is None:
+            self.pending_backfill.add(set(self.__load_metadata()))
+            self.__save_state(submitting=True)
+            with timed_call('openai', 'batches.create'):
+                batch = client.batches.create(input_file_id=self.state['input_file_id'], endpoint='/v1/responses',
+                                              completion_window='24h')
+            print(f'Submitted batch {batch.id}')
+        else:
+            print(f'Resuming batch {batch.id}')
+        self.__save_state(batch_id=batch.id, submitted=True)
+
+    def poll(self) -> None:
+        client = self.email_analyzer.client
+        while True:
+            with timed_call('openai', 'batches.retrieve'):
+                batch = client.batches.retrieve(self.state['batch_id'])
+            if batch.status in TERMINAL_BATCH_STATUSES:
+                break
+            print(f'Batch {batch.id} is {batch.status}, checking again in {self.poll_interval_seconds}s...')
+            time.sleep(self.poll_interval_seconds)
+        if not batch.output_file_id:
+            raise RuntimeError(f'Batch {batch.id} ended as {batch.status} without an output file')
+        # a failed or expired batch may still have completed some requests; apply those and leave the rest NULL
+        print(f'Batch {batch.id} {batch.status}')
+        self.__save_state(output_file_id=batch.output_file_id, finished=True)
+
+    def download(self) -> None:
+        with timed_call('openai', 'files.content'):
+            content = self.email_analyzer.client.files.content(self.state['output_file_id'])
+            content.write_to_file(self.__path('output.jsonl.tmp'))
+        os.replace(self.__path('output.jsonl.tmp'), self.__path('output.jsonl'))
+        self.__save_state(downloaded=True)
+
+    def apply(self) -> None:
+        metadata = self.__load_metadata()
+        applied_lines = self.state.get('applied_lines', 0)
+        chunk: list[Email] = []
+        line_number = 0
+        with open(self.__path('output.jsonl')) as output_file, \
+                MySqlConnector(self.secrets.mysql_password, self.username, response_cache=self.response_cache) as mysql_connector:
+            for line_number, line in enumerate(output_file, start=1):
+                if line_number <= applied_lines:
+                    continue
+                email = self.__make_email(json.loads(line), metadata)
+                if email is not None:
+                    chunk.append(email)
+                if len(chunk) == self.chunk_size:
+                    mysql_connector.sync_emails_to_db(chunk)
+                    self.__save_state(applied_lines=line_number)
+                    chunk = []
+            if chunk:
+                mysql_connector.sync_emails_to_db(chunk)
+        self.pending_backfill.clear()
+        self.__save_state(applied_lines=line_number, applied=True)
+
+    def __find_batch(self, input_file_id: str) -> Optional[Any]:
+        """
+        :return: the batch created from the input file, or None if there is none
+        """
+        with timed_call('openai', 'batches.list'):
+            # the listing is paginated automatically, newest first
+            for batch in self.email_analyzer.client.batches.list(limit=100):
+                if batch.input_file_id == input_file_id:
+                    return batch
+        return None
+
+    def __make_email(self, result: dict[str, Any], metadata: dict[str, dict[str, Any]]) -> Optional[Email]:
+        gmail_id = result['custom_id']
+        response = result.get('response') or {}
+        if result.get('error') or response.get('status_code') != 200:
+            print(f'Batch request for {gmail_id} failed: {result.get("error") or response}')
+            return None
+        try:
+            analysis = json.loads(self.get_output_text(response['body']))
+            priority = self.email_analyzer.get_email_priority(analysis)
+        except (json.JSONDecodeError, KeyError, TypeError) as error:
+            print(f'Malformed analysis for {gmail_id}: {error}')
+            return None
+        email_metadata = metadata[gmail_id]
+        return Email(gmail_id, email_metadata['link'], datetime.fromisoformat(email_metadata['time_sent']),
+                     email_metadata['sent_from'], email_metadata['subject'], '', priority)
+
+    @staticmethod
+    def get_output_text(response_body: dict[str, Any]) -> str:
+        """Equivalent of Response.output_text for a response serialized in a batch output file."""
+        return ''.join(content['text']
+                       for output in response_body['output'] if output.get('type') == 'message'
+                       for content in output['content'] if content.get('type') == 'output_text')
+
+    def __load_metadata(self) -> dict[str, dict[str, Any]]:
+        with open(self.__path('metadata.jsonl')) as metadata_file:
+            return {metadata['gmail_id']: metadata for metadata in map(json.loads, metadata_file)}
+
+    def __load_state(self) -> dict[str, Any]:
+        try:
+            with open(self.__path('state.json')) as state_file:
+                return json.load(state_file)
+        except FileNotFoundError:
+            return {}
+
+    def __save_state(self, **changes: Any) -> None:
+        self.state.update(changes)
+        with open(self.__path('state.json.tmp'), 'w') as state_file:
+            json.dump(self.state, state_file)
+        os.replace(self.__path('state.json.tmp'), self.__path('state.json'))
+
+    def __path(self, filename: str) -> str:
+        return os.path.join(self.work_dir, filename)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Classify the backlog of unprioritized emails through the batch API.')
+    parser.add_argument('credentials_file', help='authorized user credentials JSON (as stored in the session)')
+    parser.add_argument('--work-dir', default='backfill', help='directory holding batch files and progress; reuse it to resume')
+    parser.add_argument('--chunk-size', type=int, default=500, help='number of emails written to the database per commit')
+    parser.add_argument('--poll-interval', type=float, default=30, help='seconds between batch status checks')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    with open(args.credentials_file) as credentials_file:
+        credentials_json = credentials_file.read()
+    BackfillJob(Secrets.from_env(), credentials_json, args.work_dir, args.chunk_size, args.poll_interval).run()
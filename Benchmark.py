@@ -0,0 +1,341 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from typing import Any, Optional
+from redis import Redis
+from Backfill import BackfillJob
+from BenchmarkFakes import FAKE_CREDENTIALS_JSON, FakeGmailService, FakeOpenAIServer
+from Email import Priority
+from EmailRetriever import EmailRetriever
+from MySqlConnector import MySqlConnector
+from ResponseCache import ResponseCache
+from Secrets import Secrets
+from SyncPipeline import SCOPES, SyncPipeline, SyncProgress
+
+
+def summarize(samples: list[float]) -> dict[str, float]:
+    """Latency percentiles, in milliseconds."""
+    if not samples:
+        return {'count': 0}
+    milliseconds = sorted(sample * 1000 for sample in samples)
+    percentiles = statistics.quantiles(milliseconds, n=100, method='inclusive') if len(milliseconds) > 1 else milliseconds * 99
+    return {'count': len(milliseconds), 'mean': statistics.fmean(milliseconds), 'p50': percentiles[49],
+            'p90': percentiles[89], 'p99': percentiles[98], 'max': milliseconds[-1]}
+
+
+def benchmark_sync(size: int, username: str, args: argparse.Namespace, redis_client: Redis,
+                   openai_server: FakeOpenAIServer) -> dict[str, Any]:
+    """Runs a full first-time sync of a fake inbox of `size` emails into an empty schema."""
+    secrets = Secrets('', args.mysql_password, True, openai_server.base_url, args.openai_concurrency,
+                      args.openai_requests_per_second, args.emails_per_request)
+    schema_name = MySqlConnector.get_schema_name(username)
+    gmail_service = FakeGmailService(size, args.gmail_latency)
+    stage_timings: dict[str, list[float]] = {}
+    pipeline = SyncPipeline(secrets, FAKE_CREDENTIALS_JSON, username, schema_name, ResponseCache(redis_client),
+                            SyncProgress(redis_client, schema_name), stage_timings=stage_timings)
+    pipeline.email_retriever = EmailRetriever(FAKE_CREDENTIALS_JSON, SCOPES, service=gmail_service)
+    openai_requests_before = openai_server.request_count
+
+    tracemalloc.start()
+    started_at = time.perf_counter()
+    pipeline.run()
+    elapsed = time.perf_counter() - started_at
+    (_, peak_memory) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'seconds': elapsed,
+        'emails_per_second': size / elapsed,
+        'peak_memory_bytes': peak_memory,
+        'gmail_round_trips': gmail_service.round_trips,
+        'openai_requests': openai_server.request_count - openai_requests_before,
+        'stage_latency_ms': {stage: summarize(samples) for stage, samples in stage_timings.items()},
+    }
+
+
+def benchmark_priorities_api(username: str, args: argparse.Namespace, redis_client: Redis) -> dict[str, Any]:
+    """Pages through /api/priorities/{priority} on the FastAPI app, first with a cold and then with a warm cache."""
+    from fastapi.testclient import TestClient
+    import main
+
+    schema_name = MySqlConnector.get_schema_name(username)
+    session = main.SessionContext('benchmark', FAKE_CREDENTIALS_JSON, username, schema_name, True)
+    main.app.dependency_overrides[main.get_user_session] = lambda: session
+    response_cache = ResponseCache(redis_client)
+    response_cache.invalidate(schema_name)
+    results: dict[str, Any] = {}
+    with TestClient(main.app) as client:
+        for phase in ('cold_cache', 'warm_cache'):
+            stats_before = response_cache.get_stats()
+            latencies: list[float] = []
+            cursors: dict[str, Any] = {}
+            tracemalloc.start()
+            started_at = time.perf_counter()
+            for request_number in range(args.api_requests):
+                priority = ('low', 'medium', 'high')[request_number % 3]
+                params = {'page_size': args.page_size}
+                if cursors.get(priority):
+                    params['cursor'] = cursors[priority]
+                request_started_at = time.perf_counter()
+                response = client.get(f'/api/priorities/{priority}', params=params)
+                latencies.append(time.perf_counter() - request_started_at)
+                response.raise_for_status()
+                cursors[priority] = response.json()['next_cursor']
+            elapsed = time.perf_counter() - started_at
+            (_, peak_memory) = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            stats_after = response_cache.get_stats()
+            results[phase] = {
+                'requests_per_second': args.api_requests / elapsed,
+                'peak_memory_bytes': peak_memory,
+                'latency_ms': summarize(latencies),
+                'cache_hits': stats_after['hits'] - stats_before['hits'],
+                'cache_misses': stats_after['misses'] - stats_before['misses'],
+            }
+    main.app.dependency_overrides.clear()
+    return results
+
+
+def benchmark_concurrent_priorities_api(username: str, args: argparse.Namespace, redis_client: Redis) -> dict[str, Any]:
+    """
+    Serves /api/priorities/{priority} to args.concurrency concurrent clients, with real session cookies, from
+    1. threadpool: the previous request path, a sync handler making blocking Redis and MySql calls
+    2. async:      the app's async request path
+    Each run starts with a cold response cache.
+    """
+    import main
+
+    schema_name = MySqlConnector.get_schema_name(username)
+    session_id = f'benchmark-{username}'
+    redis_client.hset(f'session:{session_id}', mapping={'credentials': FAKE_CREDENTIALS_JSON, 'username': username,
+                                                        'schema_name': schema_name, 'has_pulled_emails_recently': 'true'})
+    cookies = {main.SESSION_COOKIE: main.signer.sign(session_id).decode()}
+    response_cache = ResponseCache(redis_client)
+    results: dict[str, Any] = {}
+    try:
+        for (name, app) in (('threadpool', make_threadpool_app(args, redis_client)), ('async', main.app)):
+            response_cache.invalidate(schema_name)
+            stats_before = response_cache.get_stats()
+            (elapsed, latencies) = asyncio.run(drive_concurrently(app, cookies, args))
+            stats_after = response_cache.get_stats()
+            results[name] = {
+                'requests_per_second': len(latencies) / elapsed,
+                'latency_ms': summarize(latencies),
+                'cache_hits': stats_after['hits'] - stats_before['hits'],
+                'cache_misses': stats_after['misses'] - stats_before['misses'],
+            }
+    finally:
+        redis_client.delete(f'session:{session_id}')
+    return results
+
+
+def make_threadpool_app(args: argparse.Namespace, redis_client: Redis):
+    """
+    Baseline for benchmark_concurrent_priorities_api: the /api/priorities handler as it was before the request path
+    went async, run by FastAPI on its threadpool.
+    """
+    from fastapi import FastAPI, HTTPException, Request, Response
+    from fastapi.encoders import jsonable_encoder
+    from itsdangerous import Signer
+    import main
+
+    app = FastAPI()
+    signer: Signer = main.signer
+    response_cache = ResponseCache(redis_client)
+
+    @app.get('/api/priorities/{priority}')
+    def get_emails_with_priority(request: Request, priority: str, page_size: int = 50, cursor: Optional[str] = None):
+        session_id = signer.unsign(request.cookies[main.SESSION_COOKIE]).decode()
+        session = redis_client.hgetall(f'session:{session_id}')
+        (cached_response, generation) = response_cache.get(session['schema_name'], priority, page_size, cursor)
+        if cached_response is not None:
+            return Response(content=cached_response, media_type='application/json')
+        with MySqlConnector(args.mysql_password, session['username'], session['schema_name']) as mysql_connector:
+            try:
+                (emails, next_cursor) = mysql_connector.retrieve_emails_with_priority(Priority(priority), page_size, cursor)
+            except ValueError:
+                raise HTTPException(status_code=400, detail='Invalid cursor')
+        response_json = json.dumps(jsonable_encoder({'emails': emails, 'next_cursor': next_cursor}))
+        response_cache.set(session['schema_name'], priority, page_size, cursor, generation, response_json)
+        return Response(content=response_json, media_type='application/json')
+
+    return app
+
+
+async def drive_concurrently(app, cookies: dict[str, str], args: argparse.Namespace) -> tuple[float, list[float]]:
+    """
+    Runs args.concurrency clients in parallel, each paging through one priority (cycling back to the first page at
+    the end) until args.api_requests requests have been made in total.
+    :return: (elapsed seconds, latency of each request)
+    """
+    import httpx
+
+    latencies: list[float] = []
+    requests_per_client = max(1, args.api_requests // args.concurrency)
+
+    async def run_client(client: httpx.AsyncClient, client_number: int) -> None:
+        priority = ('low', 'medium', 'high')[client_number % 3]
+        cursor = None
+        for _ in range(requests_per_client):
+            params = {'page_size': args.page_size}
+            if cursor:
+                params['cursor'] = cursor
+            request_started_at = time.perf_counter()
+            response = await client.get(f'/api/priorities/{priority}', params=params)
+            latencies.append(time.perf_counter() - request_started_at)
+            response.raise_for_status()
+            cursor = response.json()['next_cursor']
+
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://benchmark',
+                                     cookies=cookies) as client:
+            started_at = time.perf_counter()
+            await asyncio.gather(*(run_client(client, client_number) for client_number in range(args.concurrency)))
+            elapsed = time.perf_counter() - started_at
+    return elapsed, latencies
+
+
+def run_backfill(secrets: Secrets, work_dir: str, size: int, username: str) -> None:
+    """Runs the BackfillJob of a fake inbox. Target of the processes started by check_backfill_resume."""
+    gmail_service = FakeGmailService(size, email_address=f'{username}@gmail.com')
+    BackfillJob(secrets, FAKE_CREDENTIALS_JSON, work_dir, poll_interval_seconds=0.1, gmail_service=gmail_service).run()
+
+
+def check_backfill_resume(size: int, username: str, args: argparse.Namespace,
+                          openai_server: FakeOpenAIServer) -> dict[str, Any]:
+    """
+    Backfills a fake inbox of `size` emails stored without a priority, killing the backfill process while its batch
+    is being created (before it could record the batch) and running it again in the same work directory.
+    :raises RuntimeError: unless the resumed run reused the batch and every email got a priority
+    """
+    gmail_service = FakeGmailService(size, email_address=f'{username}@gmail.com')
+    with MySqlConnector(args.mysql_password, username) as mysql_connector:
+        # as left by syncs that could not classify them
+        mysql_connector.sync_emails_to_db(list(EmailRetriever(FAKE_CREDENTIALS_JSON, SCOPES,
+                                                              service=gmail_service).retrieve_emails()))
+    secrets = Secrets('', args.mysql_password, True, openai_server.base_url)
+    work_dir = tempfile.mkdtemp(prefix='backfill-')
+    # a fresh interpreter, so the killed process shares no connections with this one
+    context = multiprocessing.get_context('spawn')
+    batches_before = len(openai_server.batches)
+
+    started_at = time.perf_counter()
+    openai_server.batch_created.clear()
+    openai_server.release_batch_creation.clear()
+    openai_server.hold_batch_creation = True
+    try:
+        process = context.Process(target=run_backfill, args=(secrets, work_dir, size, username))
+        process.start()
+        if not openai_server.batch_created.wait(timeout=10 * 60):
+            process.kill()
+            raise RuntimeError('The backfill did not create its batch')
+        process.kill()
+        process.join()
+    finally:
+        openai_server.hold_batch_creation = False
+        openai_server.release_batch_creation.set()
+    process = context.Process(target=run_backfill, args=(secrets, work_dir, size, username))
+    process.start()
+    process.join()
+    elapsed = time.perf_counter() - started_at
+    if process.exitcode != 0:
+        raise RuntimeError(f'The resumed backfill exited with {process.exitcode}')
+
+    with MySqlConnector(args.mysql_password, username) as mysql_connector:
+        unclassified = len(mysql_connector.get_gmail_ids_without_priority())
+    batches_created = len(openai_server.batches) - batches_before
+    if batches_created != 1 or unclassified:
+        raise RuntimeError(f'The resumed backfill created {batches_created} batches and left {unclassified} emails '
+                           f'without a priority')
+    return {'seconds': elapsed, 'batches_created': batches_created, 'unclassified_after': unclassified}
+
+
+def drop_schema(username: str, args: argparse.Namespace, redis_client: Redis) -> None:
+    schema_name = MySqlConnector.get_schema_name(username)
+    with MySqlConnector(args.mysql_password, username) as mysql_connector:
+        with mysql_connector.mydb.cursor() as cursor:
+            cursor.execute(f'DROP SCHEMA IF EXISTS {schema_name}')
+    ResponseCache(redis_client).invalidate(schema_name)
+    redis_client.delete(SyncProgress.get_key(schema_name))
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description='Offline end-to-end benchmark of inbox syncs and the priorities API. Gmail and OpenAI are faked '
+                    'locally; a local MySql server (root, MYSQL_PASSWORD) and Redis are required, as for the app.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 10_000, 100_000], help='inbox sizes to benchmark')
+    parser.add_argument('--output', default='benchmark_results.json', help='JSON file the results are written to')
+    parser.add_argument('--mysql-password', default=os.getenv('MYSQL_PASSWORD', ''))
+    parser.add_argument('--gmail-latency', type=float, default=0.05, help='seconds per fake Gmail round trip')
+    parser.add_argument('--openai-latency', type=float, default=0.2, help='seconds per fake OpenAI request')
+    parser.add_argument('--openai-concurrency', type=int, default=8)
+    parser.add_argument('--openai-requests-per-second', type=float, default=1000)
+    parser.add_argument('--emails-per-request', type=int, default=1)
+    parser.add_argument('--api-requests', type=int, default=300, help='requests per /api/priorities phase')
+    parser.add_argument('--page-size', type=int, default=50)
+    parser.add_argument('--concurrency', type=int, default=64, help='concurrent clients in the concurrent API scenario')
+    parser.add_argument('--backfill-size', type=int, default=100,
+                        help='inbox size of the backfill crash and resume check (0 to skip it)')
+    parser.add_argument('--keep-data', action='store_true', help='keep the benchmark schemas instead of dropping them')
+    return parser.parse_args()
+
+
+def main_benchmark() -> None:
+    args = parse_args()
+    output_path = os.path.abspath(args.output)
+    # the app expects apikey.json, .env values and a public directory relative to the working directory
+    os.environ.setdefault('MYSQL_PASSWORD', args.mysql_password)
+    os.environ.setdefault('GMAIL_API_CLIENT_SECRET_FILENAME', 'unused.json')
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    working_directory = tempfile.mkdtemp(prefix='email-sorting-benchmark-')
+    os.chdir(working_directory)
+    os.mkdir('public')
+    with open('apikey.json', 'w') as api_key_file:
+        json.dump({'api_key': 'fake-api-key'}, api_key_file)
+
+    redis_client = Redis(host='localhost', port=6379, db=0, decode_responses=True)
+    openai_server = FakeOpenAIServer(args.openai_latency).start()
+    results = []
+    try:
+        for size in args.sizes:
+            username = f'benchmark_{size}_{int(time.time())}'
+            print(f'Benchmarking {size} emails...')
+            try:
+                result = {'size': size, 'sync': benchmark_sync(size, username, args, redis_client, openai_server)}
+                result['priorities_api'] = benchmark_priorities_api(username, args, redis_client)
+                result['concurrent_priorities_api'] = benchmark_concurrent_priorities_api(username, args, redis_client)
+            finally:
+                if not args.keep_data:
+                    drop_schema(username, args, redis_client)
+            print(json.dumps(result, indent=2))
+            results.append(result)
+        if args.backfill_size:
+            username = f'backfill_{args.backfill_size}_{int(time.time())}'
+            print(f'Checking that a backfill of {args.backfill_size} emails resumes after being killed...')
+            try:
+                result = {'size': args.backfill_size,
+                          'backfill_resume': check_backfill_resume(args.backfill_size, username, args, openai_server)}
+            finally:
+                if not args.keep_data:
+                    drop_schema(username, args, redis_client)
+            print(json.dumps(result, indent=2))
+            results.append(result)
+    finally:
+        openai_server.stop()
+
+    with open(output_path, 'w') as output_file:
+        config = {key: value for key, value in vars(args).items() if key != 'mysql_password'}
+        json.dump({'finished_at': datetime.now().isoformat(), 'config': config, 'results': results}, output_file, indent=2)
+    print(f'Results written to {output_path}')
+
+
+if __name__ == '__main__':
+    main_benchmark()
@@ -0,0 +1,314 @@
+import base64
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Optional
+
+FAKE_CREDENTIALS_JSON = json.dumps({
+    'token': 'fake-token',
+    'refresh_token': 'fake-refresh-token',
+    'client_id': 'fake-client-id',
+    'client_secret': 'fake-client-secret',
+})
+
+
+class FakeGmailRequest:
+    def __init__(self, service: 'FakeGmailService', handler: Callable[[], Any]):
+        self.service = service
+        self.handler = handler
+
+    def execute(self) -> Any:
+        self.service.simulate_round_trip()
+        return self.handler()
+
+
+class FakeGmailBatch:
+    def __init__(self, service: 'FakeGmailService', callback: Callable[[str, Any, Optional[Exception]], None]):
+        self.service = service
+        self.callback = callback
+        self.requests: list[tuple[str, FakeGmailRequest]] = []
+
+    def add(self, request: FakeGmailRequest, request_id: str) -> None:
+        self.requests.append((request_id, request))
+
+    def execute(self) -> None:
+        # a batch costs one round trip, however many requests it holds
+        self.service.simulate_round_trip()
+        for request_id, request in self.requests:
+            self.callback(request_id, request.handler(), None)
+
+
+class FakeGmailService:
+    """
+    In-memory stand-in for the googleapiclient Gmail service used by EmailRetriever.
+    Serves message_count unread messages with synthetic multipart/alternative payloads whose sizes follow a
+    long-tailed distribution similar to real mail. Every call (or batch) sleeps for latency_seconds.
+    """
+    SENDERS = [f'Person {i} <person{i}@example.com>' for i in range(400)] + \
+              [f'Service {i} <no-reply@service{i}.example.com>' for i in range(100)]
+
+    def __init__(self, message_count: int, latency_seconds: float = 0.0, seed: int = 0,
+                 email_address: str = 'benchmark@gmail.com'):
+        self.message_ids = [f'{i:016x}' for i in range(message_count)]
+        self.email_address = email_address
+        self.latency_seconds = latency_seconds
+        self.seed = seed
+        self.round_trips = 0
+        self.lock = threading.Lock()
+
+    def simulate_round_trip(self) -> None:
+        with self.lock:
+            self.round_trips += 1
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+
+    def users(self) -> 'FakeGmailService':
+        return self
+
+    def messages(self) -> 'FakeGmailService':
+        return self
+
+    def history(self) -> 'FakeGmailHistory':
+        return FakeGmailHistory(self)
+
+    def new_batch_http_request(self, callback) -> FakeGmailBatch:
+        return FakeGmailBatch(self, callback)
+
+    def getProfile(self, userId: str) -> FakeGmailRequest:
+        return FakeGmailRequest(self, lambda: {'emailAddress': self.email_address, 'historyId': '1'})
+
+    def get(self, userId: str, id: str, format: str = 'full', metadataHeaders: list[str] = None) -> FakeGmailRequest:
+        return FakeGmailRequest(self, lambda: self.make_message(id, format, metadataHeaders))
+
+    def make_message(self, message_id: str, message_format: str, metadata_headers: Optional[list[str]]) -> dict[str, Any]:
+        rng = random.Random(f'{self.seed}:{message_id}')
+        sent_from = rng.choice(self.SENDERS)
+        headers = [{'name': 'From', 'value': sent_from},
+                   {'name': 'Subject', 'value': f'Synthetic message {message_id} ' + ' '.join(rng.choices(WORDS, k=6))},
+                   {'name': 'To', 'value': 'benchmark@gmail.com'}]
+        if 'no-reply' in sent_from:
+            headers.append({'name': 'List-Unsubscribe', 'value': '<mailto:unsubscribe@example.com>'})
+        message: dict[str, Any] = {'id': message_id, 'labelIds': ['INBOX', 'UNREAD'],
+                                   'internalDate': str(int(time.time() * 1000) - rng.randrange(90 * 24 * 3600 * 1000))}
+        if message_format == 'metadata':
+            wanted = {name.lower() for name in metadata_headers or []}
+            message['payload'] = {'headers': [header for header in headers if header['name'].lower() in wanted]}
+            return message
+
+        # body sizes are log-normally distributed around ~2KB of text, with occasional very long threads
+        text = ' '.join(rng.choices(WORDS, k=max(20, int(rng.lognormvariate(5.8, 1.0)))))
+        html = f'<html><body><div>{text}</div><blockquote>{text[:len(text) // 2]}</blockquote></body></html>'
+        message['payload'] = {
+            'mimeType': 'multipart/alternative',
+            'headers': headers,
+            'parts': [
+                {'mimeType': 'text/plain', 'filename': '', 'body': {'data': encode_body(text)}},
+                {'mimeType': 'text/html', 'filename': '', 'body': {'data': encode_body(html)}},
+            ],
+        }
+        return message
+
+    # defined last: inside the class body, 'list' would otherwise shadow the builtin in later annotations
+    def list(self, userId: str, labelIds: list[str] = None, q: str = None, maxResults: int = 100,
+             pageToken: Optional[str] = None) -> FakeGmailRequest:
+        def handler() -> dict[str, Any]:
+            start = int(pageToken or 0)
+            page = self.message_ids[start:start + maxResults]
+            response: dict[str, Any] = {'messages': [{'id': message_id} for message_id in page],
+                                        'resultSizeEstimate': len(self.message_ids)}
+            if start + maxResults < len(self.message_ids):
+                response['nextPageToken'] = str(start + maxResults)
+            return response
+        return FakeGmailRequest(self, handler)
+
+
+class FakeGmailHistory:
+    def __init__(self, service: FakeGmailService):
+        self.service = service
+
+    def list(self, userId: str, startHistoryId: str, historyTypes: list[str] = None,
+             pageToken: Optional[str] = None) -> FakeGmailRequest:
+        return FakeGmailRequest(self.service, lambda: {'history': [], 'historyId': startHistoryId})
+
+
+class FakeOpenAIServer:
+    """
+    Local OpenAI-compatible server for EmailAnalyzer and the BackfillJob, answering after latency_seconds:
+    - POST /v1/responses: single requests get one analysis; packed (email_analyses) requests get one analysis per
+      "Email id"
+    - the files (create, content) and batches (create, retrieve, list) endpoints used by the BackfillJob. A batch
+      completes batch_latency_seconds after it is created, with every request answered as by /v1/responses.
+    Set hold_batch_creation to keep batch creation requests waiting (after the batch is created) until
+    release_batch_creation is set, e.g. to kill the client in between.
+    """
+    def __init__(self, latency_seconds: float = 0.2, batch_latency_seconds: float = 0.0):
+        self.latency_seconds = latency_seconds
+        self.batch_latency_seconds = batch_latency_seconds
+        self.request_count = 0
+        self.files: dict[str, dict[str, Any]] = {}
+        self.file_contents: dict[str, bytes] = {}
+        # newest last
+        self.batches: dict[str, dict[str, Any]] = {}
+        self.hold_batch_creation = False
+        self.batch_created = threading.Event()
+        self.release_batch_creation = threading.Event()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get('content-length', 0))
+                body = self.rfile.read(length)
+                if self.path.endswith('/files'):
+                    self.send_json(server.create_file(self.headers.get('content-type', ''), body))
+                elif self.path.endswith('/batches'):
+                    batch = server.create_batch(json.loads(body))
+                    server.batch_created.set()
+                    if server.hold_batch_creation:
+                        server.release_batch_creation.wait(60)
+                    self.send_json(batch)
+                elif self.path.endswith('/responses'):
+                    time.sleep(server.latency_seconds)
+                    with server.lock:
+                        server.request_count += 1
+                    self.send_json(server.make_response(json.loads(body or b'{}')))
+                else:
+                    self.send_error(404)
+
+            def do_GET(self):
+                path = self.path.split('?')[0]
+                if match := re.search(r'/files/([^/]+)/content$', path):
+                    content = server.file_contents.get(match[1])
+                    if content is None:
+                        self.send_error(404)
+                        return
+                    self.send_body(content, 'application/octet-stream')
+                elif path.endswith('/batches'):
+                    batches = [server.get_batch(batch_id) for batch_id in reversed(list(server.batches))]
+                    self.send_json({'object': 'list', 'data': batches, 'has_more': False,
+                                    'first_id': batches[0]['id'] if batches else None,
+                                    'last_id': batches[-1]['id'] if batches else None})
+                elif (match := re.search(r'/batches/([^/]+)$', path)) and match[1] in server.batches:
+                    self.send_json(server.get_batch(match[1]))
+                else:
+                    self.send_error(404)
+
+            def send_json(self, response: dict[str, Any]) -> None:
+                self.send_body(json.dumps(response).encode('utf-8'), 'application/json')
+
+            def send_body(self, body: bytes, content_type: str) -> None:
+                try:
+                    self.send_response(200)
+                    self.send_header('content-type', content_type)
+                    self.send_header('content-length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    # the client was killed while waiting (see hold_batch_creation)
+                    pass
+
+            def log_message(self, format, *args):
+                pass
+
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        return f'http://127.0.0.1:{self.httpd.server_address[1]}/v1'
+
+    def start(self) -> 'FakeOpenAIServer':
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def create_file(self, content_type: str, body: bytes) -> dict[str, Any]:
+        form = BytesParser(policy=HTTP).parsebytes(f'content-type: {content_type}\r\n\r\n'.encode('utf-8') + body)
+        fields = {part.get_param('name', header='content-disposition'): part for part in form.iter_parts()}
+        content = fields['file'].get_payload(decode=True)
+        purpose = fields['purpose'].get_payload(decode=True).decode('utf-8')
+        return self.store_file(content, fields['file'].get_filename() or 'upload.jsonl', purpose)
+
+    def store_file(self, content: bytes, filename: str, purpose: str) -> dict[str, Any]:
+        with self.lock:
+            file = {'id': f'file-{len(self.files) + 1}', 'object': 'file', 'bytes': len(content),
+                    'created_at': int(time.time()), 'filename': filename, 'purpose': purpose, 'status': 'processed'}
+            self.files[file['id']] = file
+            self.file_contents[file['id']] = content
+        return file
+
+    def create_batch(self, request: dict[str, Any]) -> dict[str, Any]:
+        with self.lock:
+            batch = {'id': f'batch_{len(self.batches) + 1}', 'object': 'batch', 'endpoint': request['endpoint'],
+                     'input_file_id': request['input_file_id'], 'completion_window': request['completion_window'],
+                     'status': 'in_progress', 'output_file_id': None, 'error_file_id': None,
+                     'created_at': int(time.time()), 'request_counts': {'total': 0, 'completed': 0, 'failed': 0}}
+            self.batches[batch['id']] = batch
+        return batch
+
+    def get_batch(self, batch_id: str) -> dict[str, Any]:
+        """Completes the batch on first read once batch_latency_seconds have passed."""
+        with self.lock:
+            batch = self.batches[batch_id]
+            if batch['status'] != 'in_progress' or time.time() < batch['created_at'] + self.batch_latency_seconds:
+                return dict(batch)
+            requests = [json.loads(line) for line in self.file_contents[batch['input_file_id']].splitlines() if line]
+        output = ''.join(json.dumps({'id': f'batch_req_{index}', 'custom_id': request['custom_id'], 'error': None,
+                                     'response': {'status_code': 200, 'request_id': f'req_{index}',
+                                                  'body': self.make_response(request['body'])}}) + '\n'
+                         for index, request in enumerate(requests))
+        output_file = self.store_file(output.encode('utf-8'), f'{batch_id}_output.jsonl', 'batch_output')
+        with self.lock:
+            batch.update(status='completed', output_file_id=output_file['id'],
+                         request_counts={'total': len(requests), 'completed': len(requests), 'failed': 0})
+            return dict(batch)
+
+    def make_response(self, request: dict[str, Any]) -> dict[str, Any]:
+        user_content = ''.join(message.get('content', '') for message in request.get('input', [])
+                               if message.get('role') == 'user')
+        if request.get('text', {}).get('format', {}).get('name') == 'email_analyses':
+            gmail_ids = re.findall(r'Email id: (\S+)', user_content)
+            output = {'analyses': [dict(self.make_analysis(gmail_id), gmail_id=gmail_id) for gmail_id in gmail_ids]}
+        else:
+            output = self.make_analysis(user_content)
+        return {
+            'id': f'resp_{self.request_count}',
+            'object': 'response',
+            'created_at': int(time.time()),
+            'model': request.get('model', 'fake'),
+            'status': 'completed',
+            'parallel_tool_calls': False,
+            'tool_choice': 'auto',
+            'tools': [],
+            'output': [{
+                'type': 'message',
+                'id': f'msg_{self.request_count}',
+                'role': 'assistant',
+                'status': 'completed',
+                'content': [{'type': 'output_text', 'text': json.dumps(output), 'annotations': []}],
+            }],
+        }
+
+    @staticmethod
+    def make_analysis(seed: str) -> dict[str, Any]:
+        rng = random.Random(hashlib.sha256(seed.encode('utf-8')).hexdigest())
+        return {'action': rng.random() < 0.4, 'overdue': rng.random() < 0.05, 'due_soon': rng.random() < 0.15,
+                'urgent': rng.randint(1, 10), 'explanation': 'synthetic analysis'}
+
+
+def encode_body(text: str) -> str:
+    return base64.urlsafe_b64encode(text.encode('utf-8')).decode('ascii')
+
+
+WORDS = ('meeting project invoice please review attached schedule update deadline thanks team report quarterly '
+         'budget approval reminder follow up question draft contract shipping order account security newsletter '
+         'weekly summary friday monday tomorrow agenda notes call proposal feedback request confirm payment').split()
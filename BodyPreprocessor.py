@@ -0,0 +1,94 @@
+import re
+from html.parser import HTMLParser
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (~4 characters per token), good enough for budgeting requests."""
+    return len(text) // 4 + 1
+
+
+class HtmlTextExtractor(HTMLParser):
+    """Collects the visible text of an HTML document, keeping line breaks at block boundaries."""
+    SKIPPED_TAGS = {'script', 'style', 'head', 'title'}
+    BLOCK_TAGS = {'br', 'p', 'div', 'tr', 'li', 'ul', 'ol', 'table', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'blockquote', 'hr'}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.chunks: list[str] = []
+        self.skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIPPED_TAGS:
+            self.skip_depth += 1
+        elif tag in self.BLOCK_TAGS:
+            self.chunks.append('\n')
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIPPED_TAGS:
+            self.skip_depth = max(0, self.skip_depth - 1)
+        elif tag in self.BLOCK_TAGS:
+            self.chunks.append('\n')
+
+    def handle_data(self, data):
+        if not self.skip_depth:
+            self.chunks.append(data)
+
+    def get_text(self) -> str:
+        return ''.join(self.chunks)
+
+
+class BodyPreprocessor:
+    """
+    Shrinks an email body to the part worth sending to the LLM:
+    1. convert HTML to text
+    2. strip quoted reply history and signatures
+    3. collapse whitespace
+    4. truncate to max_tokens
+    """
+    # everything from the first of these lines on is quoted history
+    QUOTE_HEADER = re.compile(
+        r'^(on\b[^\n]*(\n[^\n]*)?\bwrote:|-{2,}\s*original message\s*-{2,}|-{2,}\s*forwarded message\s*-{2,}|'
+        r'_{20,}|from:[^\n]*\n(sent|date):)[^\n]*$',
+        re.IGNORECASE | re.MULTILINE,
+    )
+    QUOTED_LINE = re.compile(r'^\s*>.*$\n?', re.MULTILINE)
+    # '-- ' is the standard signature delimiter
+    SIGNATURE = re.compile(r'^(-- ?|sent from my \w+.*)$', re.IGNORECASE | re.MULTILINE)
+    HORIZONTAL_WHITESPACE = re.compile(r'[ \t\r\f\v\u00a0\u200b]+')
+    BLANK_LINES = re.compile(r'\n\s*\n+')
+
+    def __init__(self, max_tokens: int = 1000):
+        self.max_tokens = max_tokens
+
+    def prepare(self, body: str, mime_type: str = 'text/plain') -> str:
+        text = self.html_to_text(body) if mime_type == 'text/html' else body
+        text = self.strip_quoted_history(text)
+        text = self.collapse_whitespace(text)
+        return self.truncate(text)
+
+    @staticmethod
+    def html_to_text(html: str) -> str:
+        extractor = HtmlTextExtractor()
+        extractor.feed(html)
+        extractor.close()
+        return extractor.get_text()
+
+    def strip_quoted_history(self, text: str) -> str:
+        text = text.replace('\r\n', '\n')
+        for pattern in (self.QUOTE_HEADER, self.SIGNATURE):
+            match = pattern.search(text)
+            # never strip everything: a message that starts with a quote header is all we have
+            if match and match.start() > 0:
+                text = text[:match.start()]
+        return self.QUOTED_LINE.sub('', text)
+
+    def collapse_whitespace(self, text: str) -> str:
+        lines = (self.HORIZONTAL_WHITESPACE.sub(' ', line).strip() for line in text.split('\n'))
+        return self.BLANK_LINES.sub('\n\n', '\n'.join(lines)).strip()
+
+    def truncate(self, text: str) -> str:
+        if estimate_tokens(text) <= self.max_tokens:
+            return text
+        max_characters = self.max_tokens * 4
+        cut = text.rfind(' ', 0, max_characters)
+        return text[:cut if cut > 0 else max_characters] + ' [truncated]'
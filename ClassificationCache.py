@@ -0,0 +1,95 @@
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Optional
+from Email import Email
+from MySqlConnector import MySqlConnector
+
+
+class LruCache:
+    """
+    Thread-safe, size-bounded LRU cache whose entries expire ttl_seconds after being stored.
+    """
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Any]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            stored_at, value = entry
+            if time.monotonic() - stored_at > self.ttl_seconds:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def put(self, key: str, value: Any) -> None:
+        with self.lock:
+            self.entries[key] = (time.monotonic(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+DEFAULT_TTL_SECONDS = 24 * 60 * 60
+# shared by every ClassificationCache in the process, so repeated content is recognized across syncs and users
+_memory_tier = LruCache(max_entries=10_000, ttl_seconds=DEFAULT_TTL_SECONDS)
+
+
+class ClassificationCache:
+    """
+    Content-addressed cache of raw LLM analyses (the dict get_email_priority consumes, not the final Priority),
+    so priorities can be recomputed when thresholds change without calling the model again.
+    Lookups go to the in-process LRU tier first, then to the persistent MySql tier.
+    Only use it from one thread at a time: the persistent tier shares the caller's MySql connection.
+    """
+    def __init__(self, mysql_connector: Optional[MySqlConnector] = None, ttl_seconds: int = DEFAULT_TTL_SECONDS):
+        self.mysql_connector = mysql_connector
+        self.ttl_seconds = ttl_seconds
+
+    def get_many(self, emails: list[Email]) -> dict[str, dict[str, Any]]:
+        """
+        :return: cached analysis of every email that has one, keyed by gmail_id
+        """
+        keys = {email.gmail_id: self.get_key(email) for email in emails}
+        analyses: dict[str, dict[str, Any]] = {}
+        missing: dict[str, list[str]] = {}
+        for gmail_id, key in keys.items():
+            analysis = _memory_tier.get(key)
+            if analysis is not None:
+                analyses[gmail_id] = analysis
+            else:
+                missing.setdefault(key, []).append(gmail_id)
+
+        if missing and self.mysql_connector is not None:
+            stored = self.mysql_connector.get_cached_analyses(set(missing), self.ttl_seconds)
+            for key, analysis in stored.items():
+                _memory_tier.put(key, analysis)
+                for gmail_id in missing[key]:
+                    analyses[gmail_id] = analysis
+        return analyses
+
+    def put_many(self, emails: list[Email], analyses: dict[str, dict[str, Any]]) -> None:
+        """
+        Stores the analysis (keyed by gmail_id) of each email in both tiers.
+        """
+        by_key = {self.get_key(email): analyses[email.gmail_id] for email in emails if email.gmail_id in analyses}
+        for key, analysis in by_key.items():
+            _memory_tier.put(key, analysis)
+        if by_key and self.mysql_connector is not None:
+            self.mysql_connector.store_cached_analyses(by_key)
+            self.mysql_connector.evict_expired_analyses(self.ttl_seconds)
+
+    @staticmethod
+    def get_key(email: Email) -> str:
+        """Hash of sender, subject and whitespace/case-normalized body."""
+        normalized_body = re.sub(r'\s+', ' ', email.body or '').strip().casefold()
+        content = '\0'.join([email.sent_from or '', email.subject or '', normalized_body])
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
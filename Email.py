@@ -1,7 +1,7 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from datetime import datetime
 from enum import StrEnum
-from typing import Optional
+from typing import Callable, Optional
 
 
 class Priority(StrEnum):
@@ -17,9 +17,27 @@ class Email:
     time_sent: datetime
     sent_from: str
     subject: str
-    body: str
+    # read through the body property, which loads it on first access if it was not retrieved up front
+    _body: Optional[str]
     priority: Optional[Priority]
+    # lowercased name -> value, for the few headers used to pre-classify mail (see EmailRetriever.KEPT_HEADERS)
+    headers: dict[str, str] = field(default_factory=dict)
+    # 'text/plain' or 'text/html'
+    body_mime_type: str = 'text/plain'
+    # returns (body, body_mime_type) when the body is first read
+    body_loader: Optional[Callable[[], tuple[str, str]]] = field(default=None, compare=False)
 
+    @property
+    def body(self) -> str:
+        if self._body is None and self.body_loader is not None:
+            (self._body, self.body_mime_type) = self.body_loader()
+            self.body_loader = None
+        return self._body or ''
+
+    @body.setter
+    def body(self, body: str) -> None:
+        self._body = body
+        self.body_loader = None
 
     def __repr__(self):
         return f'Email(time_sent={self.time_sent}, sent_from={self.sent_from}, subject={self.subject}, body=...)'
@@ -1,32 +1,23 @@
 import json
-from openai import OpenAI
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from openai import APIConnectionError, APIError, APITimeoutError, InternalServerError, OpenAI, RateLimitError
 from datetime import datetime
-from typing import Any
+from typing import Any, Optional
 from operator import itemgetter
+from BodyPreprocessor import BodyPreprocessor, estimate_tokens
+from ClassificationCache import ClassificationCache
 from Email import Email, Priority
+from Metrics import timed_call
+from QuotaBudget import QuotaBudget
+from TokenBucket import TokenBucket
 
 
-def get_key_from_file(filename: str) -> str:
-    with open(filename, 'r') as f:
-        key_obj = json.load(f)
-    return key_obj['api_key']
-
-
-class EmailAnalyzer:
-    def __init__(self) -> None:
-        self.api_key = get_key_from_file('apikey.json')
-        self.now = datetime.now()
-
-    def determine_email_priority(self, email: Email) -> Priority:
-        date_sent_timestamp = self.__get_timestamp_from_datetime(email.time_sent)
-        now_timestamp = self.__get_timestamp_from_datetime(self.now)
-        client = OpenAI(api_key=self.api_key)
-        response = client.responses.parse(
-            model="gpt-4.1-nano",
-            input=[
-                {
-                    "role": "system",
-                    "content": """
+MODEL = "gpt-4.1-nano"
+# APITimeoutError is a subclass of APIConnectionError, listed for clarity
+RETRYABLE_ERRORS = (RateLimitError, InternalServerError, APIConnectionError, APITimeoutError)
+SYSTEM_PROMPT = """
         You are an assistant that analyzes emails to extract actionable information.
 
         Given an email's subject, body, and timestamps, return a JSON object with the following fields:
@@ -47,25 +38,242 @@ class EmailAnalyzer:
           "explanation": "The sender asked for a reply within a week, indicating moderate urgency."
         }
         """
+PACKED_PROMPT_SUFFIX = """
+        You will be given several emails, each introduced by its "Email id".
+        Return one analysis per email in the "analyses" array, with its "gmail_id" set to the email's id.
+        """
+ANALYSIS_FIELDS = {'action', 'overdue', 'due_soon', 'urgent', 'explanation'}
+PACKED_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "name": "email_analyses",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "analyses": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "gmail_id": {"type": "string"},
+                        "action": {"type": "boolean"},
+                        "overdue": {"type": "boolean"},
+                        "due_soon": {"type": "boolean"},
+                        "urgent": {"type": "integer"},
+                        "explanation": {"type": "string"},
+                    },
+                    "required": ["gmail_id", "action", "overdue", "due_soon", "urgent", "explanation"],
+                    "additionalProperties": False,
+                },
+            },
+        },
+        "required": ["analyses"],
+        "additionalProperties": False,
+    },
+}
+
+
+def get_key_from_file(filename: str) -> str:
+    with open(filename, 'r') as f:
+        key_obj = json.load(f)
+    return key_obj['api_key']
+
+
+class EmailAnalyzer:
+    def __init__(self, base_url: Optional[str] = None, max_concurrency: int = 8, requests_per_second: float = 5,
+                 max_retries: int = 5, cache: Optional[ClassificationCache] = None, emails_per_request: int = 1,
+                 max_tokens_per_request: int = 8000, max_body_tokens: int = 1000,
+                 token_budget: Optional[QuotaBudget] = None) -> None:
+        """
+        :param base_url: OpenAI-compatible API root. Defaults to the OpenAI API; point it at a local server for testing.
+        :param max_concurrency: maximum number of requests in flight at once
+        :param requests_per_second: sustained request rate allowed by the token bucket
+        :param max_retries: number of times a request is retried after a 429, a 5xx, a timeout or a connection error
+        :param cache: cache of previous analyses consulted before calling the model
+        :param emails_per_request: maximum number of emails packed into one request (1 disables packing)
+        :param max_tokens_per_request: approximate input token budget of a packed request
+        :param max_body_tokens: approximate token budget of each email body, after preprocessing
+        :param token_budget: global budget of LLM input tokens. Emails it cannot cover are deferred.
+        """
+        self.api_key = get_key_from_file('apikey.json')
+        self.now = datetime.now()
+        # one client (and its HTTP connection pool) is shared by every request made by this analyzer.
+        # Retries are handled here, so that they also go through the rate limiter.
+        self.client = OpenAI(api_key=self.api_key, base_url=base_url, max_retries=0)
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.rate_limiter = TokenBucket(rate=requests_per_second, capacity=max_concurrency)
+        self.cache = cache if cache is not None else ClassificationCache()
+        self.emails_per_request = emails_per_request
+        self.max_tokens_per_request = max_tokens_per_request
+        self.body_preprocessor = BodyPreprocessor(max_body_tokens)
+        self.token_budget = token_budget
+
+    def determine_email_priorities(self, emails: list[Email]) -> dict[str, Priority]:
+        """
+        Determines the priority of every email. See analyze_emails.
+        :return: priority of each email, keyed by gmail_id
+        """
+        analyses = self.analyze_emails(emails)
+        return {gmail_id: self.get_email_priority(analysis) for gmail_id, analysis in analyses.items()}
+
+    def determine_email_priority(self, email: Email) -> Priority:
+        analyses = self.analyze_emails([email])
+        if email.gmail_id not in analyses:
+            raise RuntimeError(f'Could not analyze {email}')
+        return self.get_email_priority(analyses[email.gmail_id])
+
+    def analyze_emails(self, emails: list[Email]) -> dict[str, dict[str, Any]]:
+        """
+        Analyzes every email, serving repeated content from the cache and running up to max_concurrency
+        model requests at once for the rest, each covering up to emails_per_request emails.
+        Emails whose analysis fails, or that the token budget cannot cover right now, are reported and left out of the
+        result. They are stored without a priority, which later syncs retry (see SyncPipeline's
+        unclassified_retry_limit).
+        :return: raw analysis of each email, keyed by gmail_id
+        """
+        analyses = self.cache.get_many(emails)
+        emails_to_analyze = [email for email in emails if email.gmail_id not in analyses]
+        packs = self.__take_affordable_packs(self.__pack_emails(emails_to_analyze))
+        new_analyses: dict[str, dict[str, Any]] = {}
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            futures = {executor.submit(self.analyze_packed_emails, pack): pack for pack in packs}
+            for future in as_completed(futures):
+                try:
+                    new_analyses.update(future.result())
+                except Exception as error:
+                    print(f'Error analyzing {len(futures[future])} emails: {error}')
+        # the cache is written from this thread only, since its persistent tier is not thread-safe
+        self.cache.put_many(emails_to_analyze, new_analyses)
+        analyses.update(new_analyses)
+        return analyses
+
+    def analyze_email(self, email: Email) -> dict[str, Any]:
+        response = self.__create_response(**self.build_request(email))
+        return json.loads(response.output_text)
+
+    def analyze_packed_emails(self, emails: list[Email]) -> dict[str, dict[str, Any]]:
+        """
+        Analyzes several emails with a single structured-output request, so the system prompt is only sent once.
+        Emails missing from (or malformed in) the response are analyzed one per request instead.
+        :return: raw analysis of each email, keyed by gmail_id
+        """
+        if len(emails) == 1:
+            return {emails[0].gmail_id: self.analyze_email(emails[0])}
+
+        analyses: dict[str, dict[str, Any]] = {}
+        try:
+            response = self.__create_response(**self.build_packed_request(emails))
+            packed_analyses = json.loads(response.output_text)['analyses']
+            gmail_ids = {email.gmail_id for email in emails}
+            for analysis in packed_analyses:
+                if isinstance(analysis, dict) and analysis.get('gmail_id') in gmail_ids and ANALYSIS_FIELDS <= analysis.keys():
+                    analyses[analysis.pop('gmail_id')] = analysis
+        except (json.JSONDecodeError, KeyError, TypeError) as error:
+            print(f'Malformed response analyzing {len(emails)} packed emails: {error}')
+
+        for email in emails:
+            if email.gmail_id not in analyses:
+                try:
+                    analyses[email.gmail_id] = self.analyze_email(email)
+                except Exception as error:
+                    print(f'Error analyzing {email}: {error}')
+        return analyses
+
+    def build_request(self, email: Email) -> dict[str, Any]:
+        """
+        :return: arguments of the responses API request that analyzes a single email
+        """
+        return {
+            "model": MODEL,
+            "input": [
+                {
+                    "role": "system",
+                    "content": SYSTEM_PROMPT
                 },
                 {
                     "role": "user",
                     "content": f"""
-        Current date/time: {now_timestamp}
-        Message sent: {date_sent_timestamp}
+        Current date/time: {self.__get_timestamp_from_datetime(self.now)}
+        {self.__format_email(email)}
+        """
+                }
+            ],
+            "temperature": 0
+        }
 
-        Subject: {email.subject}
+    def build_packed_request(self, emails: list[Email]) -> dict[str, Any]:
+        """
+        :return: arguments of the responses API request that analyzes all the emails at once
+        """
+        formatted_emails = '\n\n'.join(f'Email id: {email.gmail_id}\n{self.__format_email(email)}' for email in emails)
+        return {
+            "model": MODEL,
+            "input": [
+                {
+                    "role": "system",
+                    "content": SYSTEM_PROMPT + PACKED_PROMPT_SUFFIX
+                },
+                {
+                    "role": "user",
+                    "content": f"""
+        Current date/time: {self.__get_timestamp_from_datetime(self.now)}
 
-        Body:
-        {email.body}
+        {formatted_emails}
         """
                 }
             ],
-            temperature=0
-        )
+            "text": {"format": PACKED_RESPONSE_FORMAT},
+            "temperature": 0
+        }
+
+    def __pack_emails(self, emails: list[Email]) -> list[tuple[list[Email], int]]:
+        """
+        Greedily groups emails into packs of at most emails_per_request emails and max_tokens_per_request input tokens.
+        An email that exceeds the token budget on its own gets a pack to itself.
+        :return: (emails, estimated input tokens) of each pack
+        """
+        packs: list[tuple[list[Email], int]] = []
+        pack: list[Email] = []
+        pack_tokens = estimate_tokens(SYSTEM_PROMPT + PACKED_PROMPT_SUFFIX)
+        for email in emails:
+            email_tokens = estimate_tokens(self.__format_email(email))
+            if pack and (len(pack) == self.emails_per_request or pack_tokens + email_tokens > self.max_tokens_per_request):
+                packs.append((pack, pack_tokens))
+                pack = []
+                pack_tokens = estimate_tokens(SYSTEM_PROMPT + PACKED_PROMPT_SUFFIX)
+            pack.append(email)
+            pack_tokens += email_tokens
+        if pack:
+            packs.append((pack, pack_tokens))
+        return packs
+
+    def __take_affordable_packs(self, packs: list[tuple[list[Email], int]]) -> list[list[Email]]:
+        """
+        Takes tokens from the token budget for as many packs as it covers, in order. The rest are deferred.
+        """
+        if self.token_budget is None:
+            return [pack for (pack, _) in packs]
+        granted = self.token_budget.acquire_up_to(sum(pack_tokens for (_, pack_tokens) in packs))
+        affordable_packs: list[list[Email]] = []
+        for (pack, pack_tokens) in packs:
+            if pack_tokens > granted:
+                break
+            affordable_packs.append(pack)
+            granted -= pack_tokens
+        self.token_budget.release(granted)
+        deferred = sum(len(pack) for (pack, _) in packs[len(affordable_packs):])
+        if deferred:
+            print(f'LLM token budget exhausted, deferring the analysis of {deferred} emails')
+        return affordable_packs
 
-        analysis = json.loads(response.output_text)
-        return self.get_email_priority(analysis)
+    def __format_email(self, email: Email) -> str:
+        return f"""Message sent: {self.__get_timestamp_from_datetime(email.time_sent)}
+
+        Subject: {email.subject}
+
+        Body:
+        {self.body_preprocessor.prepare(email.body, email.body_mime_type)}"""
 
     @staticmethod
     def get_email_priority(analysis: dict[str, Any]) -> Priority:
@@ -79,6 +287,32 @@ class EmailAnalyzer:
             return Priority.LOW
         return Priority.LOW
 
+    def __create_response(self, **kwargs) -> Any:
+        """
+        Sends a request through the rate limiter, retrying with exponential backoff on 429 and 5xx responses, timeouts
+        and connection errors (the client's own retries are off so that every attempt goes through the rate limiter).
+        """
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.acquire()
+            try:
+                with timed_call('openai', 'responses.parse'):
+                    return self.client.responses.parse(**kwargs)
+            except RETRYABLE_ERRORS as error:
+                if attempt == self.max_retries:
+                    raise
+                time.sleep(self.__get_retry_delay(error, attempt))
+
+    @staticmethod
+    def __get_retry_delay(error: APIError, attempt: int) -> float:
+        # connection errors and timeouts have no response to read a retry-after header from
+        response = getattr(error, 'response', None)
+        retry_after = response.headers.get('retry-after') if response is not None else None
+        try:
+            return float(retry_after)
+        except (TypeError, ValueError):
+            # full jitter keeps concurrent workers from retrying in lockstep
+            return random.uniform(0, min(30.0, 0.5 * 2 ** attempt))
+
     @staticmethod
     def __get_timestamp_from_datetime(date_time: datetime) -> str:
         return f'{date_time.month}/{date_time.day}/{date_time.year} at {date_time.hour}:{date_time.minute}:{date_time.second}'
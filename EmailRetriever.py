@@ -1,97 +1,345 @@
 import base64
+import hashlib
 import json
+import threading
+from collections import OrderedDict, deque
 from datetime import datetime
 from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
+from googleapiclient import discovery_cache
+from googleapiclient.discovery import build_from_document
 from googleapiclient.errors import HttpError
 from Email import Email
-from typing import Any
+from Metrics import timed_call
+from QuotaBudget import GMAIL_QUOTA_UNITS, QuotaBudget
+from functools import cache, partial
+from typing import Any, Callable, Iterator, Optional
+from dataclasses import dataclass, field
 from enum import StrEnum
 
 
+# Gmail services built by this process, kept per thread (most recently used last) since their httplib2 connections
+# must not be shared between threads
+GMAIL_SERVICE_CACHE_SIZE = 32
+_gmail_services = threading.local()
+
+
 class MimeType(StrEnum):
     TEXT_PLAIN = 'text/plain'
     TEXT_HTML = 'text/html'
     MULTIPART_ALTERNATIVE = 'multipart/alternative'
     MULTIPART_RELATED = 'multipart/related'
+    MULTIPART_MIXED = 'multipart/mixed'
+
+
+class HistoryExpiredError(Exception):
+    """Raised when a stored historyId is too old for Gmail to return a delta. A full resync is required."""
+
+
+@dataclass()
+class HistoryDelta:
+    history_id: str
+    added_ids: set[str] = field(default_factory=set)
+    deleted_ids: set[str] = field(default_factory=set)
 
 
 class EmailRetriever:
-    def __init__(self, credentials_json: str, scopes: list[str]):
+    # headers kept on Email.headers, used by the PreClassifier to recognize bulk and automated mail
+    KEPT_HEADERS = {'list-unsubscribe', 'list-id', 'precedence', 'auto-submitted'}
+
+    def __init__(self, credentials_json: str, scopes: list[str], service: Any = None,
+                 quota: Optional[QuotaBudget] = None):
+        """
+        :param service: Gmail service to use instead of building one from the credentials (e.g. a local fake)
+        :param quota: global budget of Gmail quota units. Each call waits until its units are available.
+        """
         credentials_dict = json.loads(credentials_json)
         self.creds = Credentials.from_authorized_user_info(credentials_dict, scopes)
+        self.service = service
+        self.quota = quota
+        # ids of the messages that failed to load individually (other than deleted ones), so they can be retried
+        self.failed_message_ids: set[str] = set()
 
     def retrieve_username(self) -> str:
         """
         :return: username of user (email address = username@gmail.com)
         """
-        service = build("gmail", "v1", credentials=self.creds)
-        profile = service.users().getProfile(userId='me').execute()
+        service = self.__get_service()
+        self.__charge_quota('users.getProfile')
+        with timed_call('gmail', 'users.getProfile'):
+            profile = service.users().getProfile(userId='me').execute()
         return profile['emailAddress'].removesuffix('@gmail.com')
 
-    def retrieve_emails(self) -> list[Email]:
+    def retrieve_history_id(self) -> str:
+        """
+        :return: the mailbox's current historyId. Record it *before* a full sync so no change is missed.
+        """
+        service = self.__get_service()
+        self.__charge_quota('users.getProfile')
+        with timed_call('gmail', 'users.getProfile'):
+            profile = service.users().getProfile(userId='me').execute()
+        return profile['historyId']
+
+    def retrieve_history(self, start_history_id: str) -> HistoryDelta:
+        """
+        Reads every mailbox change since start_history_id.
+        Messages that were added, or whose labels changed so that they are now unread in the 'primary' section,
+        end up in added_ids. Messages deleted from the mailbox end up in deleted_ids.
+        :raises HistoryExpiredError: if Gmail no longer has history that far back
+        """
+        service = self.__get_service()
+        delta = HistoryDelta(start_history_id)
+        page_token = None
+        try:
+            while True:
+                self.__charge_quota('history.list')
+                with timed_call('gmail', 'history.list'):
+                    history = service.users().history().list(
+                        userId='me',
+                        startHistoryId=start_history_id,
+                        historyTypes=['messageAdded', 'messageDeleted', 'labelAdded', 'labelRemoved'],
+                        pageToken=page_token,
+                    ).execute()
+                # records are in chronological order, so later changes to a message override earlier ones
+                for record in history.get('history', []):
+                    for change in record.get('messagesAdded', []) + record.get('labelsAdded', []) + record.get('labelsRemoved', []):
+                        message = change['message']
+                        if self.__is_unread_primary(message.get('labelIds', [])):
+                            delta.added_ids.add(message['id'])
+                            delta.deleted_ids.discard(message['id'])
+                    for change in record.get('messagesDeleted', []):
+                        delta.added_ids.discard(change['message']['id'])
+                        delta.deleted_ids.add(change['message']['id'])
+                delta.history_id = history.get('historyId', delta.history_id)
+                page_token = history.get('nextPageToken')
+                if not page_token:
+                    return delta
+        except HttpError as error:
+            if error.resp.status == 404:
+                raise HistoryExpiredError(f'historyId {start_history_id} has expired') from error
+            raise
+
+    def retrieve_emails(self, select_ids_needing_body: Optional[Callable[[list[str]], set[str]]] = None,
+                        page_size: int = 500, batch_size: int = 50) -> Iterator[Email]:
+        """
+        Lazily yields every unread email in the 'primary' section of the inbox.
+        Follows nextPageToken until the listing is exhausted and fetches messages through Gmail batch requests,
+        so a full pull costs roughly one round trip per batch_size messages.
+        :param select_ids_needing_body: given a batch of message ids, returns those whose body is needed up front
+            (e.g. the ones that still need classification). The other emails are retrieved with metadata only and
+            load their body on first access. By default, every body is retrieved up front.
+        :param page_size: number of message ids requested per list call (Gmail caps this at 500)
+        :param batch_size: number of messages.get calls combined into one batch request (Gmail caps this at 100)
+        :raises HttpError: if a list call or a whole batch request fails. Messages that fail individually are skipped
+            and added to failed_message_ids instead.
+        """
         try:
             # Call the Gmail API
-            service = build("gmail", "v1", credentials=self.creds)
-            # Retrieve emails in 'primary' section of inbox
-            query = 'in:inbox -category:social -category:promotions'
-            # TODO: remove max rows
-            unread_messages = (service.users().messages().list(userId='me', labelIds=['UNREAD'], q=query, maxResults=3).execute())
-            emails: list[Email] = []
-            if unread_messages.get('resultSizeEstimate') > 0:
-                for message in unread_messages.get('messages'):
-                    msg = service.users().messages().get(userId='me', id=message['id'], format='full').execute()
-                    message_id = message['id']
-                    link = self.__make_url_from_message_id(message_id)
-                    timestamp = msg['internalDate'] # unix-like timestamp (milliseconds from 1/1/1970)
-                    time_sent = datetime.fromtimestamp(int(timestamp) // 1000)
-                    sent_from = next(header.get('value') for header in msg['payload']['headers'] if header.get('name').lower() == 'from')
-                    subject = next(header.get('value') for header in msg['payload']['headers'] if header.get('name') == 'Subject')
-                    body_base64 = self.__retrieve_body(msg.get('payload'))
-                    body = self.__decode_body(body_base64)
-                    email = Email(message_id, link, time_sent, sent_from, subject, body, None)
-                    emails.append(email)
-            return emails
+            service = self.__get_service()
+            for message_ids in self.__list_unread_message_ids(service, page_size):
+                for start in range(0, len(message_ids), batch_size):
+                    yield from self.__retrieve_emails_in_batch(service, message_ids[start:start + batch_size],
+                                                               select_ids_needing_body)
 
         except HttpError as error:
-            # TODO(developer) - Handle errors from gmail API.
             print(f"An error occurred: {error}")
-            return []
-
-    def __retrieve_body(self, payload) -> Any:
-        parts: list[Any] | None = payload.get('parts', None)
-        if parts is None:
-            return payload.get('body').get('data')
-
-        parts_mimetypes = [part.get('mimeType') for part in parts]
-        # desired mime type, in order: text/plain, text/html, multipart/alternative (contains plain & html), multipart/related. Images not supported (yet)
-        # TODO: support passing images from image/jpeg, image/png, image/gif mime types to OpenAI api
-        if MimeType.TEXT_PLAIN in parts_mimetypes:
-            index = parts_mimetypes.index(MimeType.TEXT_PLAIN)
-            part = parts[index]
-            return part.get('body').get('data')
-
-        if MimeType.TEXT_HTML in parts_mimetypes:
-            index = parts_mimetypes.index(MimeType.TEXT_HTML)
-            part = parts[index]
-            return part.get('body').get('data')
-
-        if MimeType.MULTIPART_ALTERNATIVE in parts_mimetypes:
-            index = parts_mimetypes.index(MimeType.MULTIPART_ALTERNATIVE)
-            part = parts[index]
-            return self.__retrieve_body(part)
-
-        if MimeType.MULTIPART_RELATED in parts_mimetypes:
-            index = parts_mimetypes.index(MimeType.MULTIPART_RELATED)
-            part = parts[index]
-            return self.__retrieve_body(part)
-
-        assert False
+            raise
+
+    def retrieve_emails_by_id(self, message_ids: set[str],
+                              select_ids_needing_body: Optional[Callable[[list[str]], set[str]]] = None,
+                              batch_size: int = 50) -> Iterator[Email]:
+        """
+        Lazily yields the emails with the given ids, fetched through Gmail batch requests.
+        See retrieve_emails for select_ids_needing_body and errors.
+        """
+        try:
+            service = self.__get_service()
+            message_ids = list(message_ids)
+            for start in range(0, len(message_ids), batch_size):
+                yield from self.__retrieve_emails_in_batch(service, message_ids[start:start + batch_size],
+                                                           select_ids_needing_body)
+
+        except HttpError as error:
+            print(f"An error occurred: {error}")
+            raise
+
+    def __get_service(self) -> Any:
+        """
+        Gmail service for the credentials, built from the discovery document bundled with googleapiclient the first
+        time the calling thread needs it and reused afterwards, along with its open connections. The service
+        refreshes the access token itself when it expires (or a call is rejected with 401).
+        """
+        if self.service is not None:
+            return self.service
+        services: Optional[OrderedDict] = getattr(_gmail_services, 'services', None)
+        if services is None:
+            services = _gmail_services.services = OrderedDict()
+        key = self.__get_credentials_key(self.creds)
+        service = services.get(key)
+        if service is not None:
+            services.move_to_end(key)
+            return service
+        service = build_from_document(self.__get_discovery_document(), credentials=self.creds)
+        services[key] = service
+        if len(services) > GMAIL_SERVICE_CACHE_SIZE:
+            (_, evicted_service) = services.popitem(last=False)
+            evicted_service.close()
+        return service
+
+    @staticmethod
+    def __get_credentials_key(creds: Credentials) -> str:
+        # the access token changes on every refresh, so the refresh token identifies the grant
+        identity = [creds.client_id, creds.refresh_token or creds.token, sorted(creds.scopes or [])]
+        return hashlib.sha256(json.dumps(identity).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    @cache
+    def __get_discovery_document() -> str:
+        # read once per process. Parsed by every build, since building a service modifies the parsed document.
+        return discovery_cache.get_static_doc('gmail', 'v1')
+
+    @staticmethod
+    def __is_unread_primary(label_ids: list[str]) -> bool:
+        """Label-based equivalent of the 'in:inbox -category:social -category:promotions' unread query."""
+        labels = set(label_ids)
+        return {'INBOX', 'UNREAD'} <= labels and not labels & {'CATEGORY_SOCIAL', 'CATEGORY_PROMOTIONS'}
+
+    def __charge_quota(self, operation: str, calls: int = 1) -> None:
+        if self.quota is not None:
+            self.quota.acquire(GMAIL_QUOTA_UNITS[operation] * calls)
+
+    def __list_unread_message_ids(self, service, page_size: int) -> Iterator[list[str]]:
+        """
+        Yields one list of message ids per page of unread messages.
+        """
+        # Retrieve emails in 'primary' section of inbox
+        query = 'in:inbox -category:social -category:promotions'
+        page_token = None
+        while True:
+            self.__charge_quota('messages.list')
+            with timed_call('gmail', 'messages.list'):
+                unread_messages = service.users().messages().list(
+                    userId='me', labelIds=['UNREAD'], q=query, maxResults=page_size, pageToken=page_token
+                ).execute()
+            messages = unread_messages.get('messages', [])
+            if messages:
+                yield [message['id'] for message in messages]
+            page_token = unread_messages.get('nextPageToken')
+            if not page_token:
+                return
+
+    def __retrieve_emails_in_batch(self, service, message_ids: list[str],
+                                   select_ids_needing_body: Optional[Callable[[list[str]], set[str]]]) -> list[Email]:
+        """
+        Retrieves the given messages in up to two batch requests: the full payload of the messages whose body is
+        needed up front, and the metadata (From and Subject headers only) of the others, which load their body on
+        first access. Each message is only fetched once.
+        Messages that fail to load are reported and skipped rather than failing the whole batch.
+        """
+        ids_needing_body = set(message_ids) if select_ids_needing_body is None else select_ids_needing_body(message_ids)
+        messages = self.__batch_get_messages(service, [message_id for message_id in message_ids
+                                                       if message_id in ids_needing_body], format='full')
+        metadata = self.__batch_get_messages(service, [message_id for message_id in message_ids
+                                                       if message_id not in ids_needing_body],
+                                             format='metadata', metadataHeaders=['From', 'Subject'])
+        # preserve listing order (newest first) regardless of the order responses arrived in
+        emails: list[Email] = []
+        for message_id in message_ids:
+            if message_id in messages:
+                emails.append(self.__make_email(message_id, messages[message_id], with_body=True))
+            elif message_id in metadata:
+                email = self.__make_email(message_id, metadata[message_id], with_body=False)
+                email.body_loader = partial(self.__load_body, message_id)
+                emails.append(email)
+        return emails
+
+    def __batch_get_messages(self, service, message_ids: list[str], **params) -> dict[str, Any]:
+        """
+        Calls messages.get for every id in a single batch request.
+        :return: messages keyed by id. Messages that failed to load are reported and left out, and unless they were
+            deleted, added to failed_message_ids.
+        """
+        if not message_ids:
+            return {}
+        responses: dict[str, Any] = {}
+
+        def callback(request_id: str, response: Any, exception: HttpError | None) -> None:
+            if exception is not None:
+                print(f"An error occurred retrieving message {request_id}: {exception}")
+                # a deleted message will never load, but other errors (e.g. rate limiting) are worth retrying
+                if not (isinstance(exception, HttpError) and exception.resp.status == 404):
+                    self.failed_message_ids.add(request_id)
+                return
+            responses[request_id] = response
+
+        batch = service.new_batch_http_request(callback=callback)
+        for message_id in message_ids:
+            batch.add(service.users().messages().get(userId='me', id=message_id, **params), request_id=message_id)
+        self.__charge_quota('messages.get', len(message_ids))
+        with timed_call('gmail', 'messages.batchGet'):
+            batch.execute()
+        return responses
+
+    def __make_email(self, message_id: str, msg: Any, with_body: bool) -> Email:
+        link = self.__make_url_from_message_id(message_id)
+        timestamp = msg['internalDate'] # unix-like timestamp (milliseconds from 1/1/1970)
+        time_sent = datetime.fromtimestamp(int(timestamp) // 1000)
+        # either header may be missing (e.g. drafts or malformed mail)
+        sent_from = next((header.get('value') for header in msg['payload']['headers']
+                          if header.get('name').lower() == 'from'), '')
+        subject = next((header.get('value') for header in msg['payload']['headers']
+                        if header.get('name').lower() == 'subject'), '')
+        email = Email(message_id, link, time_sent, sent_from, subject, None, None)
+        if with_body:
+            self.__attach_body(email, msg)
+        return email
+
+    def __attach_body(self, email: Email, msg: Any) -> None:
+        (body_base64, email.body_mime_type) = self.__select_body_part(msg.get('payload'))
+        email.body = self.__decode_body(body_base64)
+        email.headers = {header.get('name').lower(): header.get('value') for header in msg['payload']['headers']
+                         if header.get('name').lower() in self.KEPT_HEADERS}
+
+    def __load_body(self, message_id: str) -> tuple[str, str]:
+        """Fetches the body of a message retrieved with metadata only."""
+        service = self.__get_service()
+        self.__charge_quota('messages.get')
+        with timed_call('gmail', 'messages.get'):
+            msg = service.users().messages().get(userId='me', id=message_id, format='full').execute()
+        (body_base64, body_mime_type) = self.__select_body_part(msg.get('payload'))
+        return self.__decode_body(body_base64), body_mime_type
+
+    @staticmethod
+    def __select_body_part(payload: Any) -> tuple[Optional[str], str]:
+        """
+        Picks the part holding the message body in one breadth-first pass over the MIME tree.
+        Preference: the shallowest text/plain part, else the shallowest text/html part. Attachments are skipped.
+        Images are not supported (yet).
+        TODO: support passing images from image/jpeg, image/png, image/gif mime types to OpenAI api
+        :return: (base64 body data, mime type), or (None, text/plain) if the message has no text body
+        """
+        html_part = None
+        parts = deque([payload])
+        while parts:
+            part = parts.popleft()
+            mime_type = part.get('mimeType', '')
+            if mime_type.startswith('multipart/'):
+                parts.extend(part.get('parts', []))
+            elif part.get('filename'):
+                continue
+            elif mime_type == MimeType.TEXT_PLAIN and part.get('body', {}).get('data'):
+                return part['body']['data'], MimeType.TEXT_PLAIN
+            elif mime_type == MimeType.TEXT_HTML and html_part is None and part.get('body', {}).get('data'):
+                html_part = part
+        if html_part is not None:
+            return html_part['body']['data'], MimeType.TEXT_HTML
+        return None, MimeType.TEXT_PLAIN
 
     @staticmethod
-    def __decode_body(body_base64: str) -> str:
+    def __decode_body(body_base64: Optional[str]) -> str:
+        if body_base64 is None:
+            return ''
         decoded_body = base64.urlsafe_b64decode(body_base64)
-        return decoded_body.decode('utf-8')
+        return decoded_body.decode('utf-8', errors='replace')
 
     @staticmethod
     def __make_url_from_message_id(message_id: str) -> str:
@@ -0,0 +1,128 @@
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Optional
+from redis import Redis
+
+# Atomically claims the oldest visible job by pushing its visibility forward, so a job whose worker dies is
+# picked up again once visibility_timeout_seconds have passed.
+CLAIM_SCRIPT = """
+local job_ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, 1)
+if #job_ids == 0 then
+    return nil
+end
+local job_id = job_ids[1]
+redis.call('ZADD', KEYS[1], ARGV[2], job_id)
+local attempts = redis.call('HINCRBY', KEYS[2] .. job_id, 'attempts', 1)
+return {job_id, attempts}
+"""
+
+
+@dataclass()
+class Job:
+    job_id: str
+    session_id: str
+    schema_name: str
+    attempts: int
+
+
+class JobQueue:
+    """
+    Redis-backed queue of inbox sync jobs.
+    - At most one job per user (schema) is queued or running at a time; enqueueing a duplicate is a no-op.
+    - Claimed jobs stay in the queue, invisible for visibility_timeout_seconds. Workers extend the timeout while
+      they run, and a job whose worker died becomes visible again.
+    - Failed jobs are retried with backoff up to max_attempts times, then moved to the failed list. So are jobs
+      whose worker died on every attempt.
+    """
+    QUEUE_KEY = 'sync_jobs:queue'
+    JOB_KEY_PREFIX = 'sync_jobs:job:'
+    DEDUP_KEY_PREFIX = 'sync_jobs:dedup:'
+    FAILED_KEY = 'sync_jobs:failed'
+
+    def __init__(self, redis_client: Redis, visibility_timeout_seconds: int = 5 * 60, max_attempts: int = 3,
+                 retry_delay_seconds: int = 30):
+        self.redis_client = redis_client
+        self.visibility_timeout_seconds = visibility_timeout_seconds
+        self.max_attempts = max_attempts
+        self.retry_delay_seconds = retry_delay_seconds
+        self.claim_script = redis_client.register_script(CLAIM_SCRIPT)
+
+    def enqueue(self, session_id: str, schema_name: str, delay_seconds: float = 0) -> Optional[str]:
+        """
+        :return: the new job's id, or None if a sync of this user is already queued or running
+        """
+        job_id = str(uuid.uuid4())
+        if not self.redis_client.set(self.DEDUP_KEY_PREFIX + schema_name, job_id, nx=True,
+                                     ex=self.get_dedup_ttl(delay_seconds)):
+            return None
+        with self.redis_client.pipeline() as pipeline:
+            pipeline.hset(self.JOB_KEY_PREFIX + job_id, mapping={'session_id': session_id, 'schema_name': schema_name,
+                                                                 'attempts': 0})
+            pipeline.zadd(self.QUEUE_KEY, {job_id: time.time() + delay_seconds})
+            pipeline.execute()
+        return job_id
+
+    def get_dedup_ttl(self, delay_seconds: float) -> int:
+        # the dedup key outlives a job's whole retry schedule, in case a worker dies without cleaning it up
+        return int(delay_seconds) + self.max_attempts * (self.visibility_timeout_seconds + self.retry_delay_seconds)
+
+    def claim(self) -> Optional[Job]:
+        """
+        :return: the oldest visible job, or None if there is none
+        """
+        now = time.time()
+        result = self.claim_script(keys=[self.QUEUE_KEY, self.JOB_KEY_PREFIX],
+                                   args=[now, now + self.visibility_timeout_seconds])
+        if result is None:
+            return None
+        (job_id, attempts) = result
+        fields = self.redis_client.hgetall(self.JOB_KEY_PREFIX + job_id)
+        if not fields:
+            # acknowledged by another worker after its visibility timeout lapsed
+            self.redis_client.zrem(self.QUEUE_KEY, job_id)
+            return None
+        job = Job(job_id, fields['session_id'], fields['schema_name'], int(attempts))
+        if job.attempts > self.max_attempts:
+            # its worker died (e.g. was killed) on every attempt, so it was never failed
+            self.__move_to_failed(job, f'worker stopped responding {self.max_attempts} times')
+            return self.claim()
+        return job
+
+    def extend(self, job: Job) -> None:
+        """
+        Keeps a running job invisible to other workers for another visibility timeout, and keeps duplicates of it
+        from being enqueued meanwhile.
+        """
+        with self.redis_client.pipeline() as pipeline:
+            pipeline.zadd(self.QUEUE_KEY, {job.job_id: time.time() + self.visibility_timeout_seconds}, xx=True)
+            pipeline.expire(self.DEDUP_KEY_PREFIX + job.schema_name, self.get_dedup_ttl(0))
+            pipeline.execute()
+
+    def acknowledge(self, job: Job) -> None:
+        """Removes a finished job."""
+        with self.redis_client.pipeline() as pipeline:
+            pipeline.zrem(self.QUEUE_KEY, job.job_id)
+            pipeline.delete(self.JOB_KEY_PREFIX + job.job_id)
+            pipeline.delete(self.DEDUP_KEY_PREFIX + job.schema_name)
+            pipeline.execute()
+
+    def fail(self, job: Job, error: BaseException) -> None:
+        """Schedules a failed job for retry, or moves it to the failed list once it has used up its attempts."""
+        if job.attempts < self.max_attempts:
+            delay = self.retry_delay_seconds * 2 ** (job.attempts - 1)
+            self.redis_client.zadd(self.QUEUE_KEY, {job.job_id: time.time() + delay}, xx=True)
+            return
+        self.__move_to_failed(job, str(error))
+
+    def get_depth(self) -> int:
+        """Number of queued and running jobs."""
+        return self.redis_client.zcard(self.QUEUE_KEY)
+
+    def __move_to_failed(self, job: Job, reason: str) -> None:
+        with self.redis_client.pipeline() as pipeline:
+            pipeline.lpush(self.FAILED_KEY, f'{job.job_id} {job.schema_name}: {reason}')
+            pipeline.ltrim(self.FAILED_KEY, 0, 999)
+            pipeline.execute()
+        self.acknowledge(job)
+
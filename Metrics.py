@@ -0,0 +1,122 @@
+import sys
+import threading
+import time
+import traceback
+from collections import Counter as StackCounter
+from contextlib import contextmanager
+from typing import Iterator
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+from redis import Redis
+from redis import asyncio as redis_asyncio
+from redis.client import Pipeline
+
+# Prometheus metrics shared by everything in the process. Scraped from the web app at /metrics; worker processes
+# expose their own with `python Worker.py --metrics-port`.
+EXTERNAL_CALLS = Counter('email_sorting_external_calls', 'Calls to Gmail, OpenAI, MySql and Redis',
+                         ['service', 'operation', 'outcome'])
+EXTERNAL_CALL_SECONDS = Histogram('email_sorting_external_call_seconds', 'Latency of calls to Gmail, OpenAI, MySql and Redis',
+                                  ['service', 'operation'],
+                                  buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30))
+SYNC_STAGE_SECONDS = Histogram('email_sorting_sync_stage_seconds',
+                               'Time spent by each sync stage per item (fetch: per email, classify and persist: per micro-batch)',
+                               ['stage'])
+SYNC_SECONDS = Histogram('email_sorting_sync_seconds', 'Duration of whole inbox syncs', ['outcome'],
+                         buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600))
+SYNCS_IN_FLIGHT = Gauge('email_sorting_syncs_in_flight', 'Inbox syncs currently running in this process')
+PIPELINE_QUEUE_DEPTH = Gauge('email_sorting_pipeline_queue_depth', 'Items waiting between sync stages in this process',
+                             ['queue'])
+JOB_QUEUE_DEPTH = Gauge('email_sorting_job_queue_depth', 'Sync jobs queued or running (see JobQueue)')
+RESPONSE_CACHE_LOOKUPS = Gauge('email_sorting_response_cache_lookups',
+                               '/api/priorities cache lookups by every process so far (see ResponseCache)', ['outcome'])
+
+
+@contextmanager
+def timed_call(service: str, operation: str) -> Iterator[None]:
+    """
+    Counts and times one call to an external service. Works as a context manager or as a decorator.
+    """
+    started_at = time.perf_counter()
+    outcome = 'error'
+    try:
+        yield
+        outcome = 'ok'
+    finally:
+        EXTERNAL_CALL_SECONDS.labels(service, operation).observe(time.perf_counter() - started_at)
+        EXTERNAL_CALLS.labels(service, operation, outcome).inc()
+
+
+def render_metrics() -> tuple[bytes, str]:
+    """
+    :return: (body, content type) of the Prometheus text exposition of every metric
+    """
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+
+class InstrumentedRedis(Redis):
+    """
+    Redis client that times every command (labelled by command name) and every pipeline execution.
+    Scripts are timed as EVALSHA.
+    """
+    def execute_command(self, *args, **options):
+        with timed_call('redis', str(args[0]).upper()):
+            return super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None) -> 'InstrumentedPipeline':
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+class InstrumentedPipeline(Pipeline):
+    def execute(self, raise_on_error: bool = True):
+        with timed_call('redis', 'PIPELINE'):
+            return super().execute(raise_on_error)
+
+
+class InstrumentedAsyncRedis(redis_asyncio.Redis):
+    """
+    asyncio counterpart of InstrumentedRedis.
+    """
+    async def execute_command(self, *args, **options):
+        with timed_call('redis', str(args[0]).upper()):
+            return await super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None) -> 'InstrumentedAsyncPipeline':
+        return InstrumentedAsyncPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+class InstrumentedAsyncPipeline(redis_asyncio.client.Pipeline):
+    async def execute(self, raise_on_error: bool = True):
+        with timed_call('redis', 'PIPELINE'):
+            return await super().execute(raise_on_error)
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of every other thread in the process every interval_seconds while running, without any
+    tracing overhead in between. Handlers run on worker threads, so requests served concurrently show up too.
+    Output is in collapsed-stack format (one 'frame;frame;frame count' line per stack), ready for flamegraph tools.
+    """
+    def __init__(self, interval_seconds: float = 0.005):
+        self.interval_seconds = interval_seconds
+        self.samples: StackCounter = StackCounter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.__sample, name='sampling-profiler', daemon=True)
+
+    def __enter__(self) -> 'SamplingProfiler':
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stopped.set()
+        self.thread.join()
+
+    def __sample(self) -> None:
+        while not self.stopped.wait(self.interval_seconds):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == self.thread.ident:
+                    continue
+                stack = ';'.join(f'{entry.name} ({entry.filename}:{entry.lineno})'
+                                 for entry in traceback.extract_stack(frame))
+                self.samples[stack] += 1
+
+    def render(self) -> str:
+        return '\n'.join(f'{stack} {count}' for stack, count in self.samples.most_common())
@@ -1,25 +1,78 @@
+import asyncio
+import base64
 import hashlib
-from typing import Any
+import json
+import re
+import threading
+import time
+import weakref
+from collections import Counter
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Optional
 from mysql import connector
+from mysql.connector import pooling
+from mysql.connector.aio import pooling as aio_pooling
 from Email import Email, Priority, EmailMetadata
+from Metrics import timed_call
+from ResponseCache import ResponseCache
+
+POOL_SIZE = 16
+POOL_CHECKOUT_TIMEOUT_SECONDS = 10
+# shared by every MySqlConnector in the process. Created on first use, since it needs the password.
+_pool: Optional[pooling.MySQLConnectionPool] = None
+# schemas whose tables have already been created by this process
+_initialized_schemas: set[str] = set()
+_pool_lock = threading.Lock()
+_schema_lock = threading.Lock()
+# columns of the emails table that make up an EmailMetadata, in constructor order
+EMAIL_METADATA_COLUMNS = 'gmail_id, link, time_sent, sent_from, subject, priority'
+# emails written (and committed) per statement by sync_emails_to_db
+SYNC_CHUNK_SIZE = 500
+# shorter words are not indexed by InnoDB FULLTEXT indexes (innodb_ft_min_token_size)
+FULLTEXT_MIN_TOKEN_SIZE = 3
+# the web app's read path only needs a few connections, since none of them is held while waiting on anything else
+ASYNC_POOL_SIZE = 8
+# pools of AsyncMySqlConnector, one per event loop since connections are bound to the loop that opened them
+_async_pools: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+_async_pools_lock = threading.Lock()
+# tables summarizing the emails table, kept up to date by every write to it (see __update_aggregates)
+AGGREGATE_TABLES = ('priority_counts', 'sender_counts', 'daily_counts')
+# (priority, sent_from, time_sent) of an email, as counted by the aggregate tables
+AggregateRow = tuple[Optional[str], Optional[str], datetime]
+# time_sent of emails stored before the column became NOT NULL without one
+EPOCH = datetime(1970, 1, 1)
+
+
+@dataclass()
+class SyncResult:
+    """Outcome of sync_emails_to_db, in emails."""
+    inserted: int = 0
+    updated: int = 0
+    skipped: int = 0
 
 
 class MySqlConnector:
-    def __init__(self, password: str, username: str):
+    def __init__(self, password: str, username: str, schema_name: Optional[str] = None,
+                 response_cache: Optional[ResponseCache] = None):
+        """
+        Checks a connection out of the process-wide pool and selects the user's schema.
+        The schema and its tables are only created the first time a process uses them.
+        :param schema_name: the user's schema name, if already known (see get_schema_name)
+        :param response_cache: cache of the user's API responses, invalidated whenever their emails change
+        """
         self.connection_failed = False
         self.mydb = None
+        self.schema_name = schema_name or self.get_schema_name(username)
+        self.response_cache = response_cache
+        # whether sync_emails_to_db is loading an initially empty table (decided on its first call)
+        self.bulk_loading: Optional[bool] = None
+        # gmail_ids inserted so far by the bulk load, the only emails it can find already stored
+        self.bulk_loaded_ids: set[str] = set()
         try:
-            self.mydb = connector.connect(
-                host='localhost',
-                user='root',
-                password=password,
-            )
-            schema_name = self.__get_hashed_schema_name(username)
-            print(f'Creating schema {schema_name} if it does not already exist...')
-            self.__create_schema_if_not_exist(schema_name)
-            print(f'Creating table if it does not already exist...')
-            self.__create_table_if_not_exists()
-            print('Successfully connected to MySql!')
+            self.mydb = self.__get_pooled_connection(password)
+            self.__initialize_schema_once(self.schema_name)
+            self.mydb.cmd_init_db(self.schema_name)
         except connector.Error as err:
             print(f'Error connecting to MySql: {err}')
             self.connection_failed = True
@@ -30,19 +83,79 @@ class MySqlConnector:
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.close_connection()
 
-    def get_gmail_ids_without_priority(self) -> set[str]:
+    @timed_call('mysql', 'get_gmail_ids_without_priority')
+    def get_gmail_ids_without_priority(self, limit: Optional[int] = None) -> set[str]:
         """
         Retrieves all gmail_ids where priority is NULL.
+        :param limit: if given, only retrieve the limit most recent ones
         """
         if not self.mydb.is_connected():
             raise ConnectionError('Connection to MySql closed')
 
         query = "SELECT gmail_id FROM emails WHERE priority IS NULL"
+        params: tuple[Any, ...] = ()
+        if limit is not None:
+            query += " ORDER BY time_sent DESC LIMIT %s"
+            params = (limit,)
         with self.mydb.cursor() as cursor:
-            cursor.execute(query)
+            cursor.execute(query, params)
             results = cursor.fetchall()
         return {row[0] for row in results}
 
+    @timed_call('mysql', 'get_gmail_ids_needing_priority')
+    def get_gmail_ids_needing_priority(self, gmail_ids: list[str]) -> set[str]:
+        """
+        Of the given gmail_ids, returns those that are not stored yet or are stored with a NULL priority.
+        """
+        if not self.mydb.is_connected():
+            raise ConnectionError('Connection to MySql closed')
+        if not gmail_ids:
+            return set()
+
+        placeholders = ', '.join(['%s'] * len(gmail_ids))
+        query = f"SELECT gmail_id FROM emails WHERE gmail_id IN ({placeholders}) AND priority IS NOT NULL"
+        with self.mydb.cursor() as cursor:
+            cursor.execute(query, tuple(gmail_ids))
+            results = cursor.fetchall()
+        return set(gmail_ids) - {row[0] for row in results}
+
+    @timed_call('mysql', 'get_sender_priority_counts')
+    def get_sender_priority_counts(self) -> dict[str, dict[Priority, int]]:
+        """
+        Counts how many emails from each sender were given each priority, from the sender_counts aggregate table.
+        :return: {sent_from: {priority: count}}
+        """
+        if not self.mydb.is_connected():
+            raise ConnectionError('Connection to MySql closed')
+
+        query = "SELECT sent_from, low_count, medium_count, high_count FROM sender_counts WHERE email_count > 0"
+        with self.mydb.cursor() as cursor:
+            cursor.execute(query)
+            results = cursor.fetchall()
+        counts: dict[str, dict[Priority, int]] = {}
+        for sent_from, *priority_counts in results:
+            sender_counts = {priority: count for priority, count in zip(Priority, priority_counts) if count > 0}
+            if sender_counts:
+                counts[sent_from] = sender_counts
+        return counts
+
+    @timed_call('mysql', 'get_stats')
+    def get_stats(self, top_senders: int = 10, days: int = 30) -> dict[str, Any]:
+        """
+        Summarizes the inbox from the aggregate tables, reading a bounded number of rows however many emails are
+        stored. See make_stats.
+        """
+        if not self.mydb.is_connected():
+            raise ConnectionError('Connection to MySql closed')
+
+        results = {}
+        with self.mydb.cursor() as cursor:
+            for name, (query, params) in self.build_stats_queries(top_senders, days).items():
+                cursor.execute(query, params)
+                results[name] = cursor.fetchall()
+        return self.make_stats(results)
+
+    @timed_call('mysql', 'retrieve_emails')
     def retrieve_emails(self, select_fields: set[str] = None) -> list[Any]:
         if not self.mydb.is_connected():
             raise ConnectionError('Connection to MySql closed')
@@ -54,46 +167,467 @@ class MySqlConnector:
                   for email_row in results]
         return emails
 
-    def retrieve_emails_with_priority(self, priority: Priority) -> list[EmailMetadata]:
+    @timed_call('mysql', 'retrieve_emails_with_priority')
+    def retrieve_emails_with_priority(self, priority: Priority, page_size: int = 50,
+                                      cursor: Optional[str] = None) -> tuple[list[EmailMetadata], Optional[str]]:
+        """
+        Retrieves one page of emails with the given priority, newest first.
+        Pages are read by seeking the (priority, time_sent, id) index, so every page costs the same however many
+        emails are stored.
+        :param cursor: next_cursor returned with the previous page, or None for the first page
+        :return: (emails, next_cursor). next_cursor is None on the last page.
+        """
+        if not self.mydb.is_connected():
+            raise ConnectionError('Connection to MySql closed')
+
+        (query, params) = self.build_priority_page_query(priority, page_size, cursor)
+        with self.mydb.cursor() as db_cursor:
+            db_cursor.execute(query, params)
+            results = db_cursor.fetchall()
+        return self.make_email_page(results, page_size)
+
+    @timed_call('mysql', 'search_emails')
+    def search_emails(self, text: Optional[str] = None, priority: Optional[Priority] = None, sender: Optional[str] = None,
+                      sent_after: Optional[datetime] = None, sent_before: Optional[datetime] = None, page_size: int = 50,
+                      cursor: Optional[str] = None) -> tuple[list[EmailMetadata], Optional[str]]:
+        """
+        Retrieves one page of the emails matching every given filter, newest first. See build_search_query.
+        :return: (emails, next_cursor). next_cursor is None on the last page.
+        """
         if not self.mydb.is_connected():
             raise ConnectionError('Connection to MySql closed')
+
+        (query, params) = self.build_search_query(text, priority, sender, sent_after, sent_before, page_size, cursor)
+        with self.mydb.cursor() as db_cursor:
+            db_cursor.execute(query, params)
+            results = db_cursor.fetchall()
+        return self.make_email_page(results, page_size)
+
+    @classmethod
+    def build_priority_page_query(cls, priority: Priority, page_size: int,
+                                  cursor: Optional[str]) -> tuple[str, tuple[Any, ...]]:
+        """
+        :return: (query, params) selecting one page of emails with the given priority
+        """
         if priority not in {'low', 'medium', 'high'}:
             raise RuntimeError(f'priority {priority} is not one of "low", "medium", "high"')
+        return cls.build_page_query(["priority = %s"], [priority.value], page_size, cursor)
+
+    @classmethod
+    def build_search_query(cls, text: Optional[str], priority: Optional[Priority], sender: Optional[str],
+                           sent_after: Optional[datetime], sent_before: Optional[datetime], page_size: int,
+                           cursor: Optional[str]) -> tuple[str, tuple[Any, ...]]:
+        """
+        :param text: words that must all appear in the subject or sender, each matched as a word prefix through the
+            FULLTEXT index
+        :param sender: prefix of the sender (e.g. a display name or address)
+        :param sent_after: inclusive lower bound of time_sent
+        :param sent_before: exclusive upper bound of time_sent
+        :return: (query, params) selecting one page of the emails matching every given filter
+        :raises ValueError: if text has no word of at least FULLTEXT_MIN_TOKEN_SIZE characters
+        """
+        conditions: list[str] = []
+        params: list[Any] = []
+        if text is not None:
+            conditions.append("MATCH (subject, sent_from) AGAINST (%s IN BOOLEAN MODE)")
+            params.append(cls.to_boolean_search(text))
+        if priority is not None:
+            conditions.append("priority = %s")
+            params.append(priority.value)
+        if sender is not None:
+            conditions.append("sent_from LIKE %s")
+            params.append(re.sub(r'([\\%_])', r'\\\1', sender) + '%')
+        if sent_after is not None:
+            conditions.append("time_sent >= %s")
+            params.append(sent_after)
+        if sent_before is not None:
+            conditions.append("time_sent < %s")
+            params.append(sent_before)
+        return cls.build_page_query(conditions, params, page_size, cursor)
+
+    @staticmethod
+    def to_boolean_search(text: str) -> str:
+        """
+        Turns free text into a boolean-mode FULLTEXT search requiring every word as a prefix,
+        e.g. 'Quarterly rep' -> '+Quarterly* +rep*'. Operators typed by the user are ignored.
+        """
+        words = [word for word in re.findall(r'\w+', text) if len(word) >= FULLTEXT_MIN_TOKEN_SIZE]
+        if not words:
+            raise ValueError(f'Search text needs a word of at least {FULLTEXT_MIN_TOKEN_SIZE} characters')
+        return ' '.join(f'+{word}*' for word in words)
+
+    @classmethod
+    def build_page_query(cls, conditions: list[str], params: list[Any], page_size: int,
+                         cursor: Optional[str]) -> tuple[str, tuple[Any, ...]]:
+        """
+        Pages are read by seeking (time_sent, id) from the cursor, newest first.
+        :return: (query, params) selecting one page of the emails matching every condition, plus one extra row that
+            tells whether there is a next page
+        :raises ValueError: if the cursor is invalid
+        """
+        conditions = list(conditions)
+        params = list(params)
+        if cursor is not None:
+            (time_sent, email_id) = cls.decode_cursor(cursor)
+            conditions.append("(time_sent < %s OR (time_sent = %s AND id < %s))")
+            params += [time_sent, time_sent, email_id]
+        where = ' AND '.join(conditions) or 'TRUE'
+        query = f"SELECT {EMAIL_METADATA_COLUMNS}, id FROM emails WHERE {where} ORDER BY time_sent DESC, id DESC LIMIT %s"
+        params.append(page_size + 1)
+        return query, tuple(params)
+
+    @classmethod
+    def make_email_page(cls, results: list[Any], page_size: int) -> tuple[list[EmailMetadata], Optional[str]]:
+        """
+        :param results: rows selected by a query from build_page_query
+        """
+        page = results[:page_size]
+        emails = [EmailMetadata(*email_row[:6]) for email_row in page]
+        next_cursor = cls.encode_cursor(page[-1][2], page[-1][6]) if len(results) > page_size else None
+        return emails, next_cursor
+
+    @staticmethod
+    def build_stats_queries(top_senders: int, days: int) -> dict[str, tuple[str, tuple[Any, ...]]]:
+        """
+        :return: {metric: (query, params)} reading each metric of get_stats from its aggregate table
+        """
+        return {
+            'priorities': ("SELECT priority, email_count FROM priority_counts WHERE email_count > 0", ()),
+            'top_high_priority_senders': (
+                "SELECT sent_from, high_count, email_count FROM sender_counts WHERE high_count > 0 "
+                "ORDER BY high_count DESC LIMIT %s", (top_senders,)),
+            'daily_volume': (
+                "SELECT day, email_count FROM daily_counts WHERE day > CURDATE() - INTERVAL %s DAY AND email_count > 0 "
+                "ORDER BY day", (days,)),
+        }
+
+    @staticmethod
+    def make_stats(results: dict[str, list[Any]]) -> dict[str, Any]:
+        """
+        :param results: rows selected by each query from build_stats_queries
+        :return: {
+            'priorities': {priority ('none' for unclassified): email count},
+            'top_high_priority_senders': [{'sent_from', 'high_count', 'email_count'}], most high-priority emails first,
+            'daily_volume': [{'day', 'email_count'}] for the last days that received emails, oldest first
+        }
+        """
+        return {
+            'priorities': {priority: email_count for priority, email_count in results['priorities']},
+            'top_high_priority_senders': [{'sent_from': sent_from, 'high_count': high_count, 'email_count': email_count}
+                                          for sent_from, high_count, email_count in results['top_high_priority_senders']],
+            'daily_volume': [{'day': day, 'email_count': email_count} for day, email_count in results['daily_volume']],
+        }
+
+    @staticmethod
+    def encode_cursor(time_sent: datetime, email_id: int) -> str:
+        """Opaque pagination cursor pointing just after the row (time_sent, email_id)."""
+        return base64.urlsafe_b64encode(json.dumps([time_sent.isoformat(), email_id]).encode('utf-8')).decode('ascii')
+
+    @staticmethod
+    def decode_cursor(cursor: str) -> tuple[datetime, int]:
+        """
+        :raises ValueError: if the cursor was not produced by encode_cursor
+        """
+        try:
+            (time_sent, email_id) = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+            return datetime.fromisoformat(time_sent), int(email_id)
+        except (TypeError, ValueError, UnicodeError) as error:
+            raise ValueError(f'Invalid cursor {cursor!r}') from error
+
+    @timed_call('mysql', 'sync_emails_to_db')
+    def sync_emails_to_db(self, emails: list[Email], chunk_size: int = SYNC_CHUNK_SIZE) -> SyncResult:
+        """
+        Insert new emails and update the priority for existing ones.
+        Emails are matched by gmail_id (which must be unique). If an email is given more than once, the last copy wins.
+        Emails are written chunk_size at a time, each chunk in one statement and its own transaction, which also
+        updates the aggregate tables. Emails whose stored priority is already up to date are skipped, and so are
+        stored emails given without a priority.
+        When the first call on this connector finds the table empty (a first-time backfill), this and later calls
+        load the emails without comparing them with the stored ones first.
+        """
+        if not self.mydb.is_connected():
+            raise ConnectionError('Connection to MySql closed')
+
+        emails = list({email.gmail_id: email for email in emails}.values())
+        if self.bulk_loading is None:
+            self.bulk_loading = self.__is_emails_table_empty()
+        result = SyncResult()
+        for start in range(0, len(emails), chunk_size):
+            chunk = emails[start:start + chunk_size]
+            if self.bulk_loading:
+                self.__bulk_load_chunk(chunk, result)
+            else:
+                self.__upsert_changed_emails(chunk, result)
+            self.mydb.commit()
+        if result.inserted or result.updated:
+            self.__invalidate_response_cache()
+        print(f'finished adding emails to database ({result.inserted} inserted, {result.updated} updated, '
+              f'{result.skipped} unchanged)')
+        return result
+
+    @timed_call('mysql', 'delete_emails')
+    def delete_emails(self, gmail_ids: set[str]) -> None:
+        """
+        Deletes the emails with the given gmail_ids (e.g. messages deleted from the mailbox).
+        """
+        if not self.mydb.is_connected():
+            raise ConnectionError('Connection to MySql closed')
+        if not gmail_ids:
+            return
+
+        placeholders = ', '.join(['%s'] * len(gmail_ids))
         with self.mydb.cursor() as cursor:
-            query = f"SELECT * FROM emails WHERE priority = '{priority.value}'"
-            cursor.execute(query)
+            # locked, so the aggregates are decremented by the rows actually deleted (see __upsert_changed_emails)
+            cursor.execute(f"SELECT priority, sent_from, time_sent FROM emails WHERE gmail_id IN ({placeholders}) "
+                           "FOR UPDATE", tuple(gmail_ids))
+            deleted_rows = cursor.fetchall()
+            cursor.execute(f"DELETE FROM emails WHERE gmail_id IN ({placeholders})", tuple(gmail_ids))
+        self.__update_aggregates(added=[], removed=deleted_rows)
+        self.mydb.commit()
+        if deleted_rows:
+            self.__invalidate_response_cache()
+
+    @timed_call('mysql', 'get_history_id')
+    def get_history_id(self) -> Optional[str]:
+        """
+        Retrieves the Gmail historyId recorded by the last successful sync, or None if the inbox has never been synced.
+        """
+        if not self.mydb.is_connected():
+            raise ConnectionError('Connection to MySql closed')
+
+        with self.mydb.cursor() as cursor:
+            cursor.execute("SELECT history_id FROM sync_state WHERE id = 1")
+            result = cursor.fetchone()
+        return None if result is None else str(result[0])
+
+    @timed_call('mysql', 'set_history_id')
+    def set_history_id(self, history_id: str) -> None:
+        if not self.mydb.is_connected():
+            raise ConnectionError('Connection to MySql closed')
+
+        sql = """
+        INSERT INTO sync_state (id, history_id, synced_at)
+        VALUES (1, %s, NOW())
+        ON DUPLICATE KEY UPDATE
+            history_id = VALUES(history_id),
+            synced_at = VALUES(synced_at)
+        """
+        with self.mydb.cursor() as cursor:
+            cursor.execute(sql, (int(history_id),))
+        self.mydb.commit()
+
+    @timed_call('mysql', 'get_cached_analyses')
+    def get_cached_analyses(self, content_hashes: set[str], max_age_seconds: int) -> dict[str, dict[str, Any]]:
+        """
+        Retrieves the cached LLM analyses stored less than max_age_seconds ago, keyed by content hash.
+        """
+        if not self.mydb.is_connected():
+            raise ConnectionError('Connection to MySql closed')
+        if not content_hashes:
+            return {}
+
+        placeholders = ', '.join(['%s'] * len(content_hashes))
+        query = f"""
+        SELECT content_hash, analysis FROM classification_cache
+        WHERE content_hash IN ({placeholders}) AND cached_at >= NOW() - INTERVAL %s SECOND
+        """
+        with self.mydb.cursor() as cursor:
+            cursor.execute(query, (*content_hashes, max_age_seconds))
             results = cursor.fetchall()
-        emails = [EmailMetadata(email_row[1], email_row[2], email_row[3], email_row[4], email_row[5], email_row[6])
-                  for email_row in results]
-        return emails
+        return {row[0]: json.loads(row[1]) for row in results}
 
-    def sync_emails_to_db(self, emails: list[Email]) -> None:
+    @timed_call('mysql', 'store_cached_analyses')
+    def store_cached_analyses(self, analyses: dict[str, dict[str, Any]]) -> None:
         """
-        Insert new emails and update the priority for existing ones.
-        Emails are matched by gmail_id (which must be unique).
+        Stores LLM analyses keyed by content hash, replacing (and refreshing the age of) existing entries.
+        """
+        if not self.mydb.is_connected():
+            raise ConnectionError('Connection to MySql closed')
+
+        sql = """
+        INSERT INTO classification_cache (content_hash, analysis, cached_at)
+        VALUES (%s, %s, NOW())
+        ON DUPLICATE KEY UPDATE
+            analysis = VALUES(analysis),
+            cached_at = VALUES(cached_at)
         """
+        data = [(content_hash, json.dumps(analysis)) for content_hash, analysis in analyses.items()]
+        with self.mydb.cursor() as cursor:
+            cursor.executemany(sql, data)
+        self.mydb.commit()
+
+    @timed_call('mysql', 'evict_expired_analyses')
+    def evict_expired_analyses(self, max_age_seconds: int) -> None:
         if not self.mydb.is_connected():
             raise ConnectionError('Connection to MySql closed')
 
+        with self.mydb.cursor() as cursor:
+            cursor.execute("DELETE FROM classification_cache WHERE cached_at < NOW() - INTERVAL %s SECOND", (max_age_seconds,))
+        self.mydb.commit()
+
+    def close_connection(self) -> None:
+        """
+        Returns the connection to the pool.
+        """
+        if self.mydb is not None:
+            self.mydb.close()
+            self.mydb = None
+
+    def __upsert_changed_emails(self, emails: list[Email], result: SyncResult) -> None:
+        placeholders = ', '.join(['%s'] * len(emails))
+        with self.mydb.cursor() as cursor:
+            # A plain SELECT would read a snapshot, so two writers updating the same row (e.g. a backfill and a sync)
+            # would both count its old priority. Locking makes the second one wait and read the first one's write.
+            cursor.execute(f"SELECT gmail_id, priority FROM emails WHERE gmail_id IN ({placeholders}) FOR UPDATE",
+                           tuple(email.gmail_id for email in emails))
+            stored_priorities = dict(cursor.fetchall())
+        new_emails = [email for email in emails if email.gmail_id not in stored_priorities]
+        # an email without a priority (e.g. not classified by this sync) never replaces a stored priority
+        changed_emails = [email for email in emails
+                          if email.gmail_id in stored_priorities and email.priority is not None
+                          and stored_priorities[email.gmail_id] != email.priority]
+        self.__upsert_emails(new_emails + changed_emails)
+        # a changed email moves from its stored priority to its new one
+        self.__update_aggregates(
+            added=[(email.priority, email.sent_from, email.time_sent) for email in new_emails + changed_emails],
+            removed=[(stored_priorities[email.gmail_id], email.sent_from, email.time_sent) for email in changed_emails])
+        result.inserted += len(new_emails)
+        result.updated += len(changed_emails)
+        result.skipped += len(emails) - len(new_emails) - len(changed_emails)
+
+    def __bulk_load_chunk(self, emails: list[Email], result: SyncResult) -> None:
+        # The table started empty, so emails are only already stored if Gmail listed them twice during the load.
+        # Those are compared with the stored copy instead, which keeps the aggregate tables exact.
+        new_emails = [email for email in emails if email.gmail_id not in self.bulk_loaded_ids]
+        repeated_emails = [email for email in emails if email.gmail_id in self.bulk_loaded_ids]
+        self.__upsert_emails(new_emails)
+        self.__update_aggregates(added=[(email.priority, email.sent_from, email.time_sent) for email in new_emails],
+                                 removed=[])
+        result.inserted += len(new_emails)
+        if repeated_emails:
+            self.__upsert_changed_emails(repeated_emails, result)
+        self.bulk_loaded_ids.update(email.gmail_id for email in new_emails)
+
+    def __upsert_emails(self, emails: list[Email]) -> int:
+        """
+        :return: the number of affected rows: 1 per inserted row, 2 per updated row, 0 per unchanged row
+        """
+        if not emails:
+            return 0
         sql = """
         INSERT INTO emails (gmail_id, link, subject, time_sent, sent_from, priority)
         VALUES (%s, %s, %s, %s, %s, %s)
         ON DUPLICATE KEY UPDATE
-            priority = VALUES(priority)
+            priority = COALESCE(VALUES(priority), priority)
         """
         data = [
             (email.gmail_id, email.link, email.subject, email.time_sent, email.sent_from, email.priority)
             for email in emails
         ]
         with self.mydb.cursor() as cursor:
+            # executemany sends an INSERT as a single multi-row statement
             cursor.executemany(sql, data)
-        self.mydb.commit()
-        print('finished adding emails to database')
+            return cursor.rowcount
 
-    def close_connection(self) -> None:
-        if self.mydb and self.mydb.is_connected():
-            self.mydb.close()
-            print('MySql connection closed')
+    def __update_aggregates(self, added: list[AggregateRow], removed: list[AggregateRow]) -> None:
+        """
+        Applies the emails added to and removed from the emails table to the aggregate tables, in the caller's
+        transaction. Each table gets one multi-row statement adding the net change of every affected row.
+        """
+        priority_deltas: Counter = Counter()
+        daily_deltas: Counter = Counter()
+        # sender_hash -> [sent_from, email_count, low_count, medium_count, high_count]
+        sender_deltas: dict[bytes, list[Any]] = {}
+        for sign, rows in ((1, added), (-1, removed)):
+            for priority, sent_from, time_sent in rows:
+                priority_deltas[priority or 'none'] += sign
+                sender_delta = sender_deltas.setdefault(self.get_sender_hash(sent_from), [sent_from, 0, 0, 0, 0])
+                sender_delta[1] += sign
+                for column, counted_priority in enumerate(Priority, start=2):
+                    if priority == counted_priority:
+                        sender_delta[column] += sign
+                daily_deltas[time_sent.date()] += sign
+
+        priority_data = [(priority, delta) for priority, delta in priority_deltas.items() if delta != 0]
+        sender_data = [(sender_hash, *delta) for sender_hash, delta in sender_deltas.items() if any(delta[1:])]
+        daily_data = [(day, delta) for day, delta in daily_deltas.items() if delta != 0]
+        with self.mydb.cursor() as cursor:
+            if priority_data:
+                cursor.executemany("""
+                INSERT INTO priority_counts (priority, email_count)
+                VALUES (%s, %s)
+                ON DUPLICATE KEY UPDATE
+                    email_count = email_count + VALUES(email_count)
+                """, priority_data)
+            if sender_data:
+                cursor.executemany("""
+                INSERT INTO sender_counts (sender_hash, sent_from, email_count, low_count, medium_count, high_count)
+                VALUES (%s, %s, %s, %s, %s, %s)
+                ON DUPLICATE KEY UPDATE
+                    email_count = email_count + VALUES(email_count),
+                    low_count = low_count + VALUES(low_count),
+                    medium_count = medium_count + VALUES(medium_count),
+                    high_count = high_count + VALUES(high_count)
+                """, sender_data)
+            if daily_data:
+                cursor.executemany("""
+                INSERT INTO daily_counts (day, email_count)
+                VALUES (%s, %s)
+                ON DUPLICATE KEY UPDATE
+                    email_count = email_count + VALUES(email_count)
+                """, daily_data)
+
+    @staticmethod
+    def get_sender_hash(sent_from: Optional[str]) -> bytes:
+        """Key of the sender in sender_counts. Matches UNHEX(SHA2(COALESCE(sent_from, ''), 256)) in MySql."""
+        return hashlib.sha256((sent_from or '').encode('utf-8')).digest()
+
+    def __is_emails_table_empty(self) -> bool:
+        with self.mydb.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM emails LIMIT 1")
+            return cursor.fetchone() is None
+
+    def __invalidate_response_cache(self) -> None:
+        if self.response_cache is not None:
+            self.response_cache.invalidate(self.schema_name)
+
+    @staticmethod
+    def __get_pooled_connection(password: str) -> pooling.PooledMySQLConnection:
+        global _pool
+        with _pool_lock:
+            if _pool is None:
+                _pool = pooling.MySQLConnectionPool(
+                    pool_name='email_sorting',
+                    pool_size=POOL_SIZE,
+                    host='localhost',
+                    user='root',
+                    password=password,
+                )
+        # the pool raises as soon as it is exhausted, so wait a little for a connection to be returned
+        deadline = time.monotonic() + POOL_CHECKOUT_TIMEOUT_SECONDS
+        with timed_call('mysql', 'get_connection'):
+            while True:
+                try:
+                    return _pool.get_connection()
+                except connector.errors.PoolError:
+                    if time.monotonic() >= deadline:
+                        raise
+                    time.sleep(0.01)
+
+    def __initialize_schema_once(self, schema_name: str) -> None:
+        if schema_name in _initialized_schemas:
+            return
+        with _schema_lock:
+            if schema_name in _initialized_schemas:
+                return
+            print(f'Creating schema {schema_name} if it does not already exist...')
+            self.__create_schema_if_not_exist(schema_name)
+            print('Creating tables if they do not already exist...')
+            self.__create_table_if_not_exists()
+            self.__create_sync_state_table_if_not_exists()
+            self.__create_classification_cache_table_if_not_exists()
+            self.__create_aggregate_tables_if_not_exist()
+            _initialized_schemas.add(schema_name)
 
     def __create_schema_if_not_exist(self, schema: str) -> None:
         with self.mydb.cursor() as cursor:
@@ -107,17 +641,270 @@ class MySqlConnector:
             gmail_id  varchar(16)                    not null,
             link      tinytext                       null,
             subject   text                           null,
-            time_sent datetime                       null,
+            time_sent datetime                       not null,
             sent_from text                           null,
             priority  enum ('low', 'medium', 'high') null,
             constraint gmail_id
-                unique (gmail_id)
+                unique (gmail_id),
+            index priority_time_sent (priority, time_sent, id),
+            index time_sent (time_sent, id),
+            index sent_from_time_sent (sent_from(64), time_sent),
+            fulltext subject_sent_from (subject, sent_from)
+        );'''
+        with self.mydb.cursor() as cursor:
+            cursor.execute(sql)
+        # tables created before the indexes were introduced
+        self.__create_index_if_not_exists('emails', 'priority_time_sent', '(priority, time_sent, id)')
+        self.__create_index_if_not_exists('emails', 'time_sent', '(time_sent, id)')
+        self.__create_index_if_not_exists('emails', 'sent_from_time_sent', '(sent_from(64), time_sent)')
+        self.__create_index_if_not_exists('emails', 'subject_sent_from', '(subject, sent_from)', kind='FULLTEXT INDEX')
+        self.__make_time_sent_not_null()
+
+    def __make_time_sent_not_null(self) -> None:
+        # tables created while time_sent was nullable. A NULL has no place in the (time_sent, id) order pages are
+        # read in, so emails stored without one are dated to the epoch, i.e. listed last
+        query = """
+        SELECT is_nullable FROM information_schema.columns
+        WHERE table_schema = DATABASE() AND table_name = 'emails' AND column_name = 'time_sent'
+        """
+        with self.mydb.cursor() as cursor:
+            cursor.execute(query)
+            (is_nullable,) = cursor.fetchone()
+            if is_nullable != 'YES':
+                return
+            print('Making emails.time_sent not null...')
+            cursor.execute("UPDATE emails SET time_sent = %s WHERE time_sent IS NULL", (EPOCH,))
+            if cursor.rowcount > 0 and self.__table_exists('aggregate_state'):
+                # daily_counts left those emails out, so have the aggregate tables rebuilt
+                cursor.execute("DELETE FROM aggregate_state")
+            self.mydb.commit()
+            cursor.execute("ALTER TABLE emails MODIFY time_sent datetime NOT NULL")
+
+    def __table_exists(self, table: str) -> bool:
+        query = """
+        SELECT COUNT(*) FROM information_schema.tables WHERE table_schema = DATABASE() AND table_name = %s
+        """
+        with self.mydb.cursor() as cursor:
+            cursor.execute(query, (table,))
+            (count,) = cursor.fetchone()
+            return count > 0
+
+    def __create_index_if_not_exists(self, table: str, index: str, definition: str, kind: str = 'INDEX') -> None:
+        query = """
+        SELECT COUNT(*) FROM information_schema.statistics
+        WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s
+        """
+        with self.mydb.cursor() as cursor:
+            cursor.execute(query, (table, index))
+            (count,) = cursor.fetchone()
+            if count == 0:
+                print(f'Creating index {index} on {table}...')
+                cursor.execute(f'CREATE {kind} {index} ON {table} {definition}')
+
+    def __create_sync_state_table_if_not_exists(self) -> None:
+        # single-row table holding the incremental sync cursor for this user's inbox
+        sql = '''CREATE TABLE IF NOT EXISTS sync_state(
+            id         tinyint unsigned               not null
+                primary key,
+            history_id bigint unsigned                not null,
+            synced_at  datetime                       null
         );'''
         with self.mydb.cursor() as cursor:
             cursor.execute(sql)
 
+    def __create_classification_cache_table_if_not_exists(self) -> None:
+        sql = '''CREATE TABLE IF NOT EXISTS classification_cache(
+            content_hash char(64)                       not null
+                primary key,
+            analysis     json                           not null,
+            cached_at    datetime                       not null,
+            index cached_at (cached_at)
+        );'''
+        with self.mydb.cursor() as cursor:
+            cursor.execute(sql)
+
+    def __create_aggregate_tables_if_not_exist(self) -> None:
+        with self.mydb.cursor() as cursor:
+            # single-row table marking that the aggregate tables were built, written in the same transaction as the
+            # build (CREATE TABLE commits, so the tables existing says nothing about their contents)
+            cursor.execute('''CREATE TABLE IF NOT EXISTS aggregate_state(
+                id       tinyint unsigned               not null
+                    primary key,
+                built_at datetime                       not null
+            );''')
+            cursor.execute('''CREATE TABLE IF NOT EXISTS priority_counts(
+                priority    enum ('low', 'medium', 'high', 'none') not null
+                    primary key,
+                email_count int                                    not null
+            );''')
+            cursor.execute('''CREATE TABLE IF NOT EXISTS sender_counts(
+                sender_hash  binary(32)                     not null
+                    primary key,
+                sent_from    text                           null,
+                email_count  int                            not null,
+                low_count    int                            not null,
+                medium_count int                            not null,
+                high_count   int                            not null,
+                index high_count (high_count)
+            );''')
+            cursor.execute('''CREATE TABLE IF NOT EXISTS daily_counts(
+                day         date                           not null
+                    primary key,
+                email_count int                            not null
+            );''')
+            cursor.execute("SELECT 1 FROM aggregate_state WHERE id = 1")
+            if cursor.fetchone() is None:
+                # emails stored before the aggregate tables were introduced, or a build that did not finish
+                self.__build_aggregate_tables()
+        self.mydb.commit()
+
+    def __build_aggregate_tables(self) -> None:
+        print('Building aggregate tables from the stored emails...')
+        with self.mydb.cursor() as cursor:
+            for table in AGGREGATE_TABLES:
+                cursor.execute(f'DELETE FROM {table}')
+            cursor.execute("""
+            INSERT INTO priority_counts (priority, email_count)
+            SELECT COALESCE(priority, 'none'), COUNT(*) FROM emails GROUP BY priority
+            """)
+            cursor.execute("""
+            INSERT INTO sender_counts (sender_hash, sent_from, email_count, low_count, medium_count, high_count)
+            SELECT UNHEX(SHA2(COALESCE(sent_from, ''), 256)) AS sender_hash, MIN(sent_from), COUNT(*),
+                   SUM(priority <=> 'low'), SUM(priority <=> 'medium'), SUM(priority <=> 'high')
+            FROM emails GROUP BY sender_hash
+            """)
+            cursor.execute("""
+            INSERT INTO daily_counts (day, email_count)
+            SELECT DATE(time_sent) AS day, COUNT(*) FROM emails GROUP BY day
+            """)
+            cursor.execute("""
+            INSERT INTO aggregate_state (id, built_at)
+            VALUES (1, NOW())
+            ON DUPLICATE KEY UPDATE
+                built_at = VALUES(built_at)
+            """)
+
     @staticmethod
-    def __get_hashed_schema_name(username: str) -> str:
+    def get_schema_name(username: str) -> str:
         """Generate a valid and unique schema name using a hash of the username."""
         hashed = hashlib.sha256(username.encode('utf-8')).hexdigest()[:32]
         return f'user_{hashed}_emails'
+
+
+class AsyncMySqlConnector:
+    """
+    asyncio counterpart of MySqlConnector for the web app's read path, backed by a small mysql.connector.aio pool.
+    Offers the same read methods as MySqlConnector, as coroutines:
+        async with AsyncMySqlConnector(password, username, schema_name) as mysql_connector:
+            (emails, next_cursor) = await mysql_connector.retrieve_emails_with_priority(priority)
+    """
+    def __init__(self, password: str, username: str, schema_name: Optional[str] = None):
+        self.password = password
+        self.username = username
+        self.schema_name = schema_name or MySqlConnector.get_schema_name(username)
+        self.mydb = None
+
+    async def __aenter__(self):
+        if self.schema_name not in _initialized_schemas:
+            # tables are created once per process, by the blocking connector
+            await asyncio.to_thread(self.__initialize_schema)
+        with timed_call('mysql', 'get_connection'):
+            self.mydb = await self.__get_pooled_connection(self.password)
+        await self.mydb.cmd_init_db(self.schema_name)
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close_connection()
+
+    async def retrieve_emails_with_priority(self, priority: Priority, page_size: int = 50,
+                                            cursor: Optional[str] = None) -> tuple[list[EmailMetadata], Optional[str]]:
+        """
+        See MySqlConnector.retrieve_emails_with_priority.
+        """
+        (query, params) = MySqlConnector.build_priority_page_query(priority, page_size, cursor)
+        with timed_call('mysql', 'retrieve_emails_with_priority'):
+            async with await self.mydb.cursor() as db_cursor:
+                await db_cursor.execute(query, params)
+                results = await db_cursor.fetchall()
+        return MySqlConnector.make_email_page(results, page_size)
+
+    async def search_emails(self, text: Optional[str] = None, priority: Optional[Priority] = None,
+                            sender: Optional[str] = None, sent_after: Optional[datetime] = None,
+                            sent_before: Optional[datetime] = None, page_size: int = 50,
+                            cursor: Optional[str] = None) -> tuple[list[EmailMetadata], Optional[str]]:
+        """
+        See MySqlConnector.search_emails.
+        """
+        (query, params) = MySqlConnector.build_search_query(text, priority, sender, sent_after, sent_before, page_size,
+                                                            cursor)
+        with timed_call('mysql', 'search_emails'):
+            async with await self.mydb.cursor() as db_cursor:
+                await db_cursor.execute(query, params)
+                results = await db_cursor.fetchall()
+        return MySqlConnector.make_email_page(results, page_size)
+
+    async def get_stats(self, top_senders: int = 10, days: int = 30) -> dict[str, Any]:
+        """
+        See MySqlConnector.get_stats.
+        """
+        results = {}
+        with timed_call('mysql', 'get_stats'):
+            async with await self.mydb.cursor() as db_cursor:
+                for name, (query, params) in MySqlConnector.build_stats_queries(top_senders, days).items():
+                    await db_cursor.execute(query, params)
+                    results[name] = await db_cursor.fetchall()
+        return MySqlConnector.make_stats(results)
+
+    async def close_connection(self) -> None:
+        """
+        Returns the connection to the pool.
+        """
+        if self.mydb is not None:
+            await self.mydb.close()
+            self.mydb = None
+
+    @staticmethod
+    async def close_pool() -> None:
+        """
+        Closes the running event loop's pool. Call when the loop shuts down (e.g. on application shutdown).
+        """
+        with _async_pools_lock:
+            pool = _async_pools.pop(asyncio.get_running_loop(), None)
+        if pool is not None:
+            await pool.close_pool()
+
+    def __initialize_schema(self) -> None:
+        MySqlConnector(self.password, self.username, self.schema_name).close_connection()
+
+    @staticmethod
+    async def __get_pooled_connection(password: str) -> aio_pooling.PooledMySQLConnection:
+        loop = asyncio.get_running_loop()
+        with _async_pools_lock:
+            pool = _async_pools.get(loop)
+            created = pool is None
+            if created:
+                pool = aio_pooling.MySQLConnectionPool(
+                    pool_name=f'email_sorting_async_{id(loop)}',
+                    pool_size=ASYNC_POOL_SIZE,
+                    host='localhost',
+                    user='root',
+                    password=password,
+                )
+                _async_pools[loop] = pool
+        if created:
+            try:
+                await pool.initialize_pool()
+            except connector.Error:
+                # let the next request try again with a fresh pool
+                with _async_pools_lock:
+                    _async_pools.pop(loop, None)
+                raise
+        # like the blocking pool, this one raises as soon as it is exhausted (or still being filled)
+        deadline = time.monotonic() + POOL_CHECKOUT_TIMEOUT_SECONDS
+        while True:
+            try:
+                return await pool.get_connection()
+            except connector.errors.PoolError:
+                if time.monotonic() >= deadline:
+                    raise
+                await asyncio.sleep(0.01)
@@ -0,0 +1,33 @@
+from redis import Redis
+
+
+class PendingBackfill:
+    """
+    Redis set of the gmail_ids a user's submitted backfill batch covers, so that syncs leave them to the batch instead
+    of classifying them a second time. It expires a little after the batch's 24h completion window, in case the
+    backfill is abandoned before it applies the results.
+    """
+    KEY_PREFIX = 'backfill_pending:'
+
+    def __init__(self, redis_client: Redis, schema_name: str, ttl_seconds: int = 26 * 60 * 60):
+        self.redis_client = redis_client
+        self.key = self.get_key(schema_name)
+        self.ttl_seconds = ttl_seconds
+
+    def add(self, gmail_ids: set[str]) -> None:
+        if not gmail_ids:
+            return
+        with self.redis_client.pipeline() as pipeline:
+            pipeline.sadd(self.key, *gmail_ids)
+            pipeline.expire(self.key, self.ttl_seconds)
+            pipeline.execute()
+
+    def get_gmail_ids(self) -> set[str]:
+        return self.redis_client.smembers(self.key)
+
+    def clear(self) -> None:
+        self.redis_client.delete(self.key)
+
+    @staticmethod
+    def get_key(schema_name: str) -> str:
+        return f'{PendingBackfill.KEY_PREFIX}{schema_name}'
@@ -0,0 +1,111 @@
+import re
+from dataclasses import dataclass
+from email.utils import parseaddr
+from typing import Optional
+from Email import Email, Priority
+
+
+@dataclass()
+class PreClassification:
+    priority: Priority
+    confidence: float
+    reason: str
+
+
+class PreClassifier:
+    """
+    Cheap local classification stage run before the EmailAnalyzer.
+    Emails are scored using the sender's priority history, sender rules and header/keyword features.
+    A priority is only assigned when the confidence reaches confidence_threshold; everything else is left to the LLM.
+    """
+    NO_REPLY_SENDER = re.compile(r'^(no-?reply|do-?not-?reply|notifications?|mailer-daemon|alerts?)([+.\-_].*)?$')
+    CALENDAR_SENDERS = {'calendar-notification@google.com'}
+    CALENDAR_RESPONSE_SUBJECT = re.compile(r'^(accepted|declined|tentatively accepted|canceled event|cancelled event)\b', re.IGNORECASE)
+    CALENDAR_INVITATION_SUBJECT = re.compile(r'^(updated )?invitation\b', re.IGNORECASE)
+    # wording that may make automated mail worth a closer look, so rules never short-circuit it
+    URGENT_KEYWORDS = re.compile(
+        r'\b(urgent|asap|action required|overdue|past due|final notice|deadline|expir(es|ing)|security alert|'
+        r'suspended|payment failed|verify your)\b',
+        re.IGNORECASE,
+    )
+
+    def __init__(self, sender_history: dict[str, dict[Priority, int]], confidence_threshold: float = 0.9,
+                 min_sender_history: int = 5):
+        """
+        :param sender_history: number of emails previously given each priority, keyed by sender address
+        :param confidence_threshold: minimum confidence needed to assign a priority without the LLM
+        :param min_sender_history: minimum number of classified emails from a sender before their history is trusted
+        """
+        # the same address may appear under several display names
+        self.sender_history: dict[str, dict[Priority, int]] = {}
+        for sender, counts in sender_history.items():
+            address_counts = self.sender_history.setdefault(self.get_sender_address(sender), {})
+            for priority, count in counts.items():
+                address_counts[priority] = address_counts.get(priority, 0) + count
+        self.confidence_threshold = confidence_threshold
+        self.min_sender_history = min_sender_history
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def classify(self, email: Email) -> Optional[PreClassification]:
+        """
+        :return: the email's classification if it is confident enough, otherwise None (the email needs the LLM)
+        """
+        candidates = [self.__classify_by_history(email), self.__classify_by_rules(email)]
+        confident = [candidate for candidate in candidates
+                     if candidate is not None and candidate.confidence >= self.confidence_threshold]
+        if not confident:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return max(confident, key=lambda candidate: candidate.confidence)
+
+    def __classify_by_history(self, email: Email) -> Optional[PreClassification]:
+        counts = self.sender_history.get(self.get_sender_address(email.sent_from))
+        if not counts:
+            return None
+        total = sum(counts.values())
+        if total < self.min_sender_history:
+            return None
+        priority, count = max(counts.items(), key=lambda item: item[1])
+        # shrink towards uncertainty for senders with little history
+        confidence = count / (total + 1)
+        return PreClassification(priority, confidence, f'{count} of {total} previous emails from sender were {priority}')
+
+    def __classify_by_rules(self, email: Email) -> Optional[PreClassification]:
+        text = f'{email.subject}\n{email.body}'
+        if self.URGENT_KEYWORDS.search(text):
+            return None
+
+        address = self.get_sender_address(email.sent_from)
+        local_part = address.split('@')[0]
+        subject = (email.subject or '').strip()
+        headers = email.headers
+        is_calendar = address in self.CALENDAR_SENDERS
+        is_no_reply = bool(self.NO_REPLY_SENDER.match(local_part))
+        is_bulk = ('list-unsubscribe' in headers or 'list-id' in headers
+                   or headers.get('precedence', '').lower() in {'bulk', 'list', 'junk'}
+                   or headers.get('auto-submitted', 'no').lower() != 'no')
+
+        if (is_calendar or is_no_reply) and self.CALENDAR_RESPONSE_SUBJECT.match(subject):
+            return PreClassification(Priority.LOW, 0.95, 'calendar response notification')
+        if is_calendar and self.CALENDAR_INVITATION_SUBJECT.match(subject):
+            # invitations usually need an answer, so a guess of medium is left for the LLM to confirm
+            return PreClassification(Priority.MEDIUM, 0.6, 'calendar invitation')
+        if is_no_reply and is_bulk:
+            return PreClassification(Priority.LOW, 0.95, 'bulk mail from a no-reply sender')
+        if is_no_reply:
+            return PreClassification(Priority.LOW, 0.9, 'no-reply sender')
+        if is_bulk:
+            return PreClassification(Priority.LOW, 0.8, 'bulk mail')
+        return None
+
+    @staticmethod
+    def get_sender_address(sent_from: Optional[str]) -> str:
+        """'Name <user@example.com>' -> 'user@example.com'"""
+        return parseaddr(sent_from or '')[1].lower()
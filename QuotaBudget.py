@@ -0,0 +1,117 @@
+import time
+from typing import Optional
+from redis import Redis
+
+# Token bucket shared by every process. Refills continuously from the Redis server's clock, then grants
+# all of the request ('all'), as much of it as is available ('partial'), or gives tokens back ('release').
+# Returns {granted, remaining} as strings, since Lua numbers are truncated to integers on the way out.
+ACQUIRE_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local refill_per_second = tonumber(ARGV[2])
+local requested = tonumber(ARGV[3])
+local mode = ARGV[4]
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+local tokens = tonumber(state[1]) or capacity
+local updated_at = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated_at) * refill_per_second)
+local granted = 0
+if mode == 'release' then
+    tokens = math.min(capacity, tokens + requested)
+elseif tokens >= requested then
+    granted = requested
+elseif mode == 'partial' then
+    granted = math.floor(tokens)
+end
+tokens = tokens - granted
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated_at', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / refill_per_second) + 60)
+return {tostring(granted), tostring(tokens)}
+"""
+
+# Gmail API quota units charged per call
+# (https://developers.google.com/workspace/gmail/api/reference/quota)
+GMAIL_QUOTA_UNITS = {
+    'users.getProfile': 1,
+    'history.list': 2,
+    'messages.list': 5,
+    'messages.get': 5,
+}
+
+
+class QuotaBudget:
+    """
+    Global budget of an external quota (Gmail quota units, LLM tokens), shared by every web, worker and scheduler
+    process through Redis. Unlike the per-process TokenBucket, it bounds the combined rate of all users.
+    """
+    KEY_PREFIX = 'quota:'
+
+    def __init__(self, redis_client: Redis, name: str, capacity: float, refill_per_second: float):
+        """
+        :param capacity: the most that can be spent in a burst
+        :param refill_per_second: sustained rate the quota allows
+        """
+        self.redis_client = redis_client
+        self.key = self.KEY_PREFIX + name
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.acquire_script = redis_client.register_script(ACQUIRE_SCRIPT)
+
+    @classmethod
+    def gmail(cls, redis_client: Redis, units_per_second: float) -> 'QuotaBudget':
+        """Gmail quota units, allowing a burst of one minute's worth."""
+        return cls(redis_client, 'gmail_units', units_per_second * 60, units_per_second)
+
+    @classmethod
+    def llm(cls, redis_client: Redis, tokens_per_minute: float) -> 'QuotaBudget':
+        """LLM input tokens, allowing a burst of one minute's worth."""
+        return cls(redis_client, 'llm_tokens', tokens_per_minute, tokens_per_minute / 60)
+
+    def try_acquire(self, amount: float) -> bool:
+        """
+        Takes amount from the budget if it is all available.
+        """
+        (granted, _) = self.__run(amount, 'all')
+        return granted > 0 or amount == 0
+
+    def acquire_up_to(self, amount: float) -> float:
+        """
+        Takes as much of amount as is available (rounded down to a whole number).
+        :return: the amount taken
+        """
+        (granted, _) = self.__run(amount, 'partial')
+        return granted
+
+    def acquire(self, amount: float, timeout_seconds: Optional[float] = None) -> bool:
+        """
+        Waits until amount is available and takes it, spreading bursts out at the sustained rate.
+        :return: False if timeout_seconds passed first
+        """
+        # more than the capacity would never become available
+        amount = min(amount, self.capacity)
+        deadline = None if timeout_seconds is None else time.monotonic() + timeout_seconds
+        while True:
+            (granted, remaining) = self.__run(amount, 'all')
+            if granted > 0 or amount == 0:
+                return True
+            wait = (amount - remaining) / self.refill_per_second
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    def release(self, amount: float) -> None:
+        """Gives back an amount that was taken but not spent."""
+        if amount > 0:
+            self.__run(amount, 'release')
+
+    def get_fill_ratio(self) -> float:
+        """
+        :return: the share of the capacity currently available, from 0 to 1
+        """
+        (_, remaining) = self.__run(0, 'all')
+        return remaining / self.capacity
+
+    def __run(self, amount: float, mode: str) -> tuple[float, float]:
+        (granted, remaining) = self.acquire_script(keys=[self.key], args=[self.capacity, self.refill_per_second, amount, mode])
+        return float(granted), float(remaining)
@@ -0,0 +1,128 @@
+from typing import Optional
+from redis import Redis
+from redis import asyncio as redis_asyncio
+
+# Each user's entries live in one hash per generation (KEYS[1] holds the current one, ARGV[1] is the hash's key
+# prefix), so that a response computed before an invalidation can never be written back after it.
+
+# returns {cached value or nil, current generation} and counts the hit or miss in the same round trip
+GET_AND_COUNT_SCRIPT = """
+local generation = redis.call('GET', KEYS[1]) or '0'
+local value = redis.call('HGET', ARGV[1] .. generation, ARGV[2])
+if value then
+    redis.call('INCR', KEYS[2])
+else
+    redis.call('INCR', KEYS[3])
+end
+return {value, generation}
+"""
+
+# stores the value only if the generation it was read under (ARGV[2]) is still current
+SET_IF_CURRENT_SCRIPT = """
+local generation = redis.call('GET', KEYS[1]) or '0'
+if generation ~= ARGV[2] then
+    return 0
+end
+local key = ARGV[1] .. generation
+redis.call('HSET', key, ARGV[3], ARGV[4])
+redis.call('EXPIRE', key, ARGV[5])
+return 1
+"""
+
+# moves to the next generation and drops the previous one's entries
+INVALIDATE_SCRIPT = """
+local generation = redis.call('INCR', KEYS[1])
+redis.call('DEL', ARGV[1] .. (generation - 1))
+return generation
+"""
+
+
+class ResponseCache:
+    """
+    Redis cache of pre-serialized /api/priorities responses.
+    Each user's entries live in one hash per generation. Invalidating them when their emails change moves the user
+    to the next generation, and a response is only stored if the generation it was read under is still current,
+    so a reader racing a sync cannot cache the page it read before the sync committed.
+    """
+    HITS_KEY = 'priorities_cache:hits'
+    MISSES_KEY = 'priorities_cache:misses'
+
+    def __init__(self, redis_client: Redis, ttl_seconds: int = 10 * 60):
+        self.redis_client = redis_client
+        self.ttl_seconds = ttl_seconds
+        self.get_and_count = redis_client.register_script(GET_AND_COUNT_SCRIPT)
+        self.set_if_current = redis_client.register_script(SET_IF_CURRENT_SCRIPT)
+        self.invalidate_script = redis_client.register_script(INVALIDATE_SCRIPT)
+
+    def get(self, schema_name: str, priority: str, page_size: int, cursor: Optional[str]) -> tuple[Optional[str], str]:
+        """
+        :return: (the cached JSON response or None on a miss, the generation to pass to set)
+        """
+        (value, generation) = self.get_and_count(keys=[self.get_generation_key(schema_name), self.HITS_KEY,
+                                                       self.MISSES_KEY],
+                                                 args=[self.get_key_prefix(schema_name),
+                                                       self.get_field(priority, page_size, cursor)])
+        return value, generation
+
+    def set(self, schema_name: str, priority: str, page_size: int, cursor: Optional[str], generation: str,
+            response_json: str) -> None:
+        """
+        :param generation: returned by the get that missed. The response is dropped if the user's emails changed since.
+        """
+        self.set_if_current(keys=[self.get_generation_key(schema_name)],
+                            args=[self.get_key_prefix(schema_name), generation,
+                                  self.get_field(priority, page_size, cursor), response_json, self.ttl_seconds])
+
+    def invalidate(self, schema_name: str) -> None:
+        """Drops every cached response of the user. Call whenever their emails change."""
+        self.invalidate_script(keys=[self.get_generation_key(schema_name)], args=[self.get_key_prefix(schema_name)])
+
+    def get_stats(self) -> dict[str, float]:
+        (hits, misses) = (int(count or 0) for count in self.redis_client.mget(self.HITS_KEY, self.MISSES_KEY))
+        total = hits + misses
+        return {'hits': hits, 'misses': misses, 'hit_rate': hits / total if total else 0.0}
+
+    @staticmethod
+    def get_generation_key(schema_name: str) -> str:
+        return f'priorities_cache:generation:{schema_name}'
+
+    @staticmethod
+    def get_key_prefix(schema_name: str) -> str:
+        """Followed by the generation, the key of the hash holding the user's entries."""
+        return f'priorities_cache:{schema_name}:'
+
+    @staticmethod
+    def get_field(priority: str, page_size: int, cursor: Optional[str]) -> str:
+        return f'{priority}:{page_size}:{cursor or ""}'
+
+
+class AsyncResponseCache:
+    """
+    asyncio view of the ResponseCache for the web app's request path. Reads and writes the same keys, so entries
+    are still invalidated by the (blocking) writers.
+    """
+    def __init__(self, redis_client: redis_asyncio.Redis, ttl_seconds: int = 10 * 60):
+        self.redis_client = redis_client
+        self.ttl_seconds = ttl_seconds
+        self.get_and_count = redis_client.register_script(GET_AND_COUNT_SCRIPT)
+        self.set_if_current = redis_client.register_script(SET_IF_CURRENT_SCRIPT)
+
+    async def get(self, schema_name: str, priority: str, page_size: int,
+                  cursor: Optional[str]) -> tuple[Optional[str], str]:
+        """
+        See ResponseCache.get.
+        """
+        (value, generation) = await self.get_and_count(
+            keys=[ResponseCache.get_generation_key(schema_name), ResponseCache.HITS_KEY, ResponseCache.MISSES_KEY],
+            args=[ResponseCache.get_key_prefix(schema_name), ResponseCache.get_field(priority, page_size, cursor)])
+        return value, generation
+
+    async def set(self, schema_name: str, priority: str, page_size: int, cursor: Optional[str], generation: str,
+                  response_json: str) -> None:
+        """
+        See ResponseCache.set.
+        """
+        await self.set_if_current(keys=[ResponseCache.get_generation_key(schema_name)],
+                                  args=[ResponseCache.get_key_prefix(schema_name), generation,
+                                        ResponseCache.get_field(priority, page_size, cursor), response_json,
+                                        self.ttl_seconds])
@@ -0,0 +1,157 @@
+import argparse
+import time
+from typing import Any
+from redis import Redis
+from redis import asyncio as redis_asyncio
+from JobQueue import JobQueue
+from Metrics import InstrumentedRedis
+from QuotaBudget import QuotaBudget
+from Secrets import Secrets
+from SyncPipeline import SyncProgress
+
+
+class SyncSchedule:
+    """
+    Redis state of the background refresh schedule:
+    - DUE_KEY: sorted set of the users (schema names) being refreshed, scored by when their next sync is due
+    - user key: hash of the user's session_id, last_active_at, interval_seconds and last_result_at (when the last
+      sync that adapted the interval finished)
+    A user stays scheduled while their session exists.
+    """
+    DUE_KEY = 'sync_schedule:due'
+    USER_KEY_PREFIX = 'sync_schedule:user:'
+    DEFAULT_INTERVAL_SECONDS = 5 * 60
+    TTL_SECONDS = 24 * 60 * 60
+
+    @classmethod
+    def get_user_key(cls, schema_name: str) -> str:
+        return cls.USER_KEY_PREFIX + schema_name
+
+
+class AsyncSyncSchedule:
+    """
+    asyncio side of the SyncSchedule used by the web app to register activity.
+    """
+    def __init__(self, redis_client: redis_asyncio.Redis):
+        self.redis_client = redis_client
+
+    async def activate(self, session_id: str, schema_name: str, sync_now: bool) -> None:
+        """
+        Records that the user is active and makes sure they are scheduled.
+        :param sync_now: make their next sync due immediately rather than at the end of their current interval
+        """
+        user_key = SyncSchedule.get_user_key(schema_name)
+        now = time.time()
+        async with self.redis_client.pipeline() as pipeline:
+            pipeline.hset(user_key, mapping={'session_id': session_id, 'last_active_at': now})
+            pipeline.hsetnx(user_key, 'interval_seconds', SyncSchedule.DEFAULT_INTERVAL_SECONDS)
+            pipeline.expire(user_key, SyncSchedule.TTL_SECONDS)
+            if sync_now:
+                # adds the user, or brings their next sync forward
+                pipeline.zadd(SyncSchedule.DUE_KEY, {schema_name: now}, lt=True)
+            else:
+                pipeline.zadd(SyncSchedule.DUE_KEY, {schema_name: now + SyncSchedule.DEFAULT_INTERVAL_SECONDS}, nx=True)
+            await pipeline.execute()
+
+
+class Scheduler:
+    """
+    Refreshes the inboxes of active sessions in the background by enqueueing sync jobs for the workers.
+    - fair: users are served in the order their syncs fall due, and have at most one sync queued or running
+    - adaptive: a user's interval halves after a sync that found new emails and doubles after one that found none,
+      between min_interval_seconds and max_interval_seconds
+    - quota-aware: while the Gmail or LLM budget is below reserve_ratio, low-value syncs (quiet inboxes of users who
+      have not visited recently) are deferred, leaving the rest of the budget to the syncs users are waiting on
+    Run one scheduler process:
+        python Scheduler.py
+    """
+    def __init__(self, redis_client: Redis, job_queue: JobQueue, gmail_quota: QuotaBudget, llm_quota: QuotaBudget,
+                 min_interval_seconds: float = 60, max_interval_seconds: float = 30 * 60, reserve_ratio: float = 0.25,
+                 recent_activity_seconds: float = 10 * 60, batch_size: int = 100):
+        self.redis_client = redis_client
+        self.job_queue = job_queue
+        self.gmail_quota = gmail_quota
+        self.llm_quota = llm_quota
+        self.min_interval_seconds = min_interval_seconds
+        self.max_interval_seconds = max_interval_seconds
+        self.reserve_ratio = reserve_ratio
+        self.recent_activity_seconds = recent_activity_seconds
+        self.batch_size = batch_size
+
+    def run_forever(self, poll_interval_seconds: float = 1) -> None:
+        print('Scheduling inbox syncs...')
+        while True:
+            if self.run_once() < self.batch_size:
+                time.sleep(poll_interval_seconds)
+
+    def run_once(self) -> int:
+        """
+        Handles up to batch_size users whose sync is due.
+        :return: number of users handled
+        """
+        now = time.time()
+        due_schema_names = self.redis_client.zrangebyscore(SyncSchedule.DUE_KEY, '-inf', now, start=0, num=self.batch_size)
+        if not due_schema_names:
+            return 0
+        budget_is_low = min(self.gmail_quota.get_fill_ratio(), self.llm_quota.get_fill_ratio()) < self.reserve_ratio
+        (enqueued, deferred) = (0, 0)
+        for schema_name in due_schema_names:
+            user_key = SyncSchedule.get_user_key(schema_name)
+            state = self.redis_client.hgetall(user_key)
+            if not state or not self.redis_client.exists(f'session:{state["session_id"]}'):
+                # the session ended, so stop refreshing the inbox
+                self.redis_client.zrem(SyncSchedule.DUE_KEY, schema_name)
+                self.redis_client.delete(user_key)
+                continue
+            interval = self.__adapt_interval(schema_name, state)
+            if budget_is_low and not self.__is_high_value(state, interval, now):
+                self.redis_client.zadd(SyncSchedule.DUE_KEY, {schema_name: now + self.min_interval_seconds})
+                deferred += 1
+                continue
+            # no-op if the user's previous sync is still queued or running
+            if self.job_queue.enqueue(state['session_id'], schema_name) is not None:
+                enqueued += 1
+            self.redis_client.zadd(SyncSchedule.DUE_KEY, {schema_name: now + interval})
+        if enqueued or deferred:
+            print(f'enqueued {enqueued} syncs, deferred {deferred} while quota budgets are low')
+        return len(due_schema_names)
+
+    def __adapt_interval(self, schema_name: str, state: dict[str, Any]) -> float:
+        """
+        Adapts the user's interval to the outcome of their last sync, once per sync.
+        """
+        interval = float(state.get('interval_seconds', SyncSchedule.DEFAULT_INTERVAL_SECONDS))
+        status = SyncProgress.get(self.redis_client, schema_name)
+        if status['state'] not in {'finished', 'failed'} or status.get('finished_at') == state.get('last_result_at'):
+            return interval
+        # emails fetched again to retry their classification don't count: the inbox itself was quiet
+        if status['state'] == 'finished' and status['new'] > 0:
+            interval = max(self.min_interval_seconds, interval / 2)
+        else:
+            interval = min(self.max_interval_seconds, interval * 2)
+        self.redis_client.hset(SyncSchedule.get_user_key(schema_name),
+                               mapping={'interval_seconds': interval, 'last_result_at': status['finished_at']})
+        state['last_result_at'] = status['finished_at']
+        return interval
+
+    def __is_high_value(self, state: dict[str, Any], interval: float, now: float) -> bool:
+        """Syncs worth spending the reserve on: first syncs, users on the page, and busy inboxes."""
+        return ('last_result_at' not in state
+                or now - float(state.get('last_active_at', 0)) < self.recent_activity_seconds
+                or interval <= self.min_interval_seconds * 2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Refresh the inboxes of active sessions in the background.')
+    parser.add_argument('--poll-interval', type=float, default=1, help='seconds to wait when no sync is due')
+    parser.add_argument('--min-interval', type=float, default=60, help='shortest seconds between syncs of a user')
+    parser.add_argument('--max-interval', type=float, default=30 * 60, help='longest seconds between syncs of a user')
+    parser.add_argument('--reserve', type=float, default=0.25,
+                        help='share of the quota budgets below which low-value syncs are deferred')
+    args = parser.parse_args()
+    secrets = Secrets.from_env()
+    redis_client = InstrumentedRedis(host='localhost', port=6379, db=0, decode_responses=True)
+    Scheduler(redis_client, JobQueue(redis_client),
+              QuotaBudget.gmail(redis_client, secrets.gmail_quota_units_per_second),
+              QuotaBudget.llm(redis_client, secrets.llm_tokens_per_minute),
+              args.min_interval, args.max_interval, args.reserve).run_forever(args.poll_interval)
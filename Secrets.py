@@ -1,5 +1,6 @@
 from dataclasses import dataclass
 from dotenv import load_dotenv
+from typing import Optional
 import os
 
 @dataclass
@@ -7,6 +8,16 @@ class Secrets:
     gmail_api_client_secret_filename: str
     mysql_password: str
     call_chatgpt_api: bool
+    openai_base_url: Optional[str] = None
+    openai_max_concurrency: int = 8
+    openai_requests_per_second: float = 5
+    openai_emails_per_request: int = 1
+    openai_max_body_tokens: int = 1000
+    # global budgets shared by every process (see QuotaBudget)
+    gmail_quota_units_per_second: float = 10000
+    llm_tokens_per_minute: int = 200000
+    # allows any request to be profiled by adding ?profile=1 (see main.profile_request)
+    enable_profiling: bool = False
 
     @staticmethod
     def from_env() -> 'Secrets':
@@ -14,6 +25,16 @@ class Secrets:
         gmail_api_client_secret_filename = os.getenv('GMAIL_API_CLIENT_SECRET_FILENAME')
         mysql_password = os.getenv('MYSQL_PASSWORD')
         call_chatgpt_api = os.getenv('CALL_CHATGPT_API', 'false').lower() == 'true'
+        openai_base_url = os.getenv('OPENAI_BASE_URL') or None
+        openai_max_concurrency = int(os.getenv('OPENAI_MAX_CONCURRENCY', '8'))
+        openai_requests_per_second = float(os.getenv('OPENAI_REQUESTS_PER_SECOND', '5'))
+        openai_emails_per_request = int(os.getenv('OPENAI_EMAILS_PER_REQUEST', '1'))
+        openai_max_body_tokens = int(os.getenv('OPENAI_MAX_BODY_TOKENS', '1000'))
+        gmail_quota_units_per_second = float(os.getenv('GMAIL_QUOTA_UNITS_PER_SECOND', '10000'))
+        llm_tokens_per_minute = int(os.getenv('LLM_TOKENS_PER_MINUTE', '200000'))
+        enable_profiling = os.getenv('ENABLE_PROFILING', 'false').lower() == 'true'
         if not gmail_api_client_secret_filename or not mysql_password:
             raise ValueError("Missing environment variables in .env")
-        return Secrets(gmail_api_client_secret_filename, mysql_password, call_chatgpt_api)
+        return Secrets(gmail_api_client_secret_filename, mysql_password, call_chatgpt_api,
+                       openai_base_url, openai_max_concurrency, openai_requests_per_second, openai_emails_per_request,
+                       openai_max_body_tokens, gmail_quota_units_per_second, llm_tokens_per_minute, enable_profiling)
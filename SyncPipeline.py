@@ -0,0 +1,325 @@
+import queue
+import random
+import threading
+import time
+from typing import Any, Optional
+from redis import Redis
+from ClassificationCache import ClassificationCache
+from Email import Email, Priority
+from EmailAnalyzer import EmailAnalyzer
+from EmailRetriever import EmailRetriever, HistoryExpiredError
+from Metrics import PIPELINE_QUEUE_DEPTH, SYNC_SECONDS, SYNC_STAGE_SECONDS, SYNCS_IN_FLIGHT
+from MySqlConnector import MySqlConnector
+from PendingBackfill import PendingBackfill
+from PreClassifier import PreClassifier
+from QuotaBudget import QuotaBudget
+from ResponseCache import ResponseCache
+from Secrets import Secrets
+
+SCOPES = ["https://www.googleapis.com/auth/gmail.readonly"]
+# marks the end of a stage's output
+DONE = object()
+
+
+class SyncProgress:
+    """
+    Per-user sync progress (fetched, classified and persisted counts), kept in Redis so that any web or worker
+    process can report it. 'new' counts the fetched emails that were new to the sync, as opposed to stored emails
+    fetched again to retry their classification.
+    """
+    TTL_SECONDS = 24 * 60 * 60
+
+    def __init__(self, redis_client: Redis, schema_name: str):
+        self.redis_client = redis_client
+        self.key = self.get_key(schema_name)
+
+    def start(self) -> None:
+        with self.redis_client.pipeline() as pipeline:
+            pipeline.delete(self.key)
+            pipeline.hset(self.key, mapping={'state': 'running', 'fetched': 0, 'new': 0, 'classified': 0,
+                                             'persisted': 0, 'started_at': time.time()})
+            pipeline.expire(self.key, self.TTL_SECONDS)
+            pipeline.execute()
+
+    def increment(self, counter: str, amount: int) -> None:
+        self.redis_client.hincrby(self.key, counter, amount)
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        mapping = {'state': 'failed' if error else 'finished', 'finished_at': time.time()}
+        if error:
+            mapping['error'] = str(error)
+        self.redis_client.hset(self.key, mapping=mapping)
+
+    @classmethod
+    def get(cls, redis_client: Redis, schema_name: str) -> dict[str, Any]:
+        status = redis_client.hgetall(cls.get_key(schema_name))
+        if not status:
+            return {'state': 'idle'}
+        for counter in ('fetched', 'new', 'classified', 'persisted'):
+            status[counter] = int(status.get(counter, 0))
+        return status
+
+    @staticmethod
+    def get_key(schema_name: str) -> str:
+        return f'sync_status:{schema_name}'
+
+
+class SyncPipeline:
+    """
+    Syncs one user's inbox with three overlapping stages connected by bounded queues:
+    1. fetch:    retrieve emails (only the changes since the last sync when possible)
+    2. classify: analyze emails if necessary, in micro-batches
+    3. persist:  upsert each micro-batch into the database as soon as it is classified
+    Memory use is bounded by the queue sizes rather than by the size of the inbox.
+    Stage timings, queue depths and in-flight syncs are recorded in the Prometheus metrics (see Metrics.py).
+    """
+    def __init__(self, secrets: Secrets, credentials_json: str, username: str, schema_name: Optional[str],
+                 response_cache: Optional[ResponseCache], progress: SyncProgress, queue_size: int = 200,
+                 micro_batch_size: int = 50, stage_timings: Optional[dict[str, list[float]]] = None,
+                 gmail_quota: Optional[QuotaBudget] = None, llm_quota: Optional[QuotaBudget] = None,
+                 unclassified_retry_limit: int = 200):
+        """
+        :param gmail_quota: global budget of Gmail quota units, waited on before each Gmail call
+        :param llm_quota: global budget of LLM tokens. Emails it cannot cover keep a NULL priority until a later sync.
+        :param unclassified_retry_limit: number of stored emails without a priority (deferred by the LLM budget or
+            whose analysis failed) that each incremental sync fetches again to classify, most recent first
+        :param stage_timings: if given, the seconds spent on each item by each stage are also appended to
+            stage_timings['plan'] (once), stage_timings['fetch'] (per email), stage_timings['classify'] and
+            stage_timings['persist'] (per micro-batch)
+        """
+        self.secrets = secrets
+        self.email_retriever = EmailRetriever(credentials_json, SCOPES, quota=gmail_quota)
+        self.username = username
+        self.schema_name = schema_name
+        self.response_cache = response_cache
+        self.progress = progress
+        self.micro_batch_size = micro_batch_size
+        self.fetched_queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        # holds micro-batches, so bound it by batch count
+        self.classified_queue: queue.Queue = queue.Queue(maxsize=max(1, queue_size // micro_batch_size))
+        self.stop_event = threading.Event()
+        self.errors: list[BaseException] = []
+        self.stage_timings = stage_timings
+        self.llm_quota = llm_quota
+        self.unclassified_retry_limit = unclassified_retry_limit
+        # stored emails fetched again to retry their classification (see __plan_fetch)
+        self.unclassified_ids: set[str] = set()
+
+    def run(self) -> None:
+        self.progress.start()
+        SYNCS_IN_FLIGHT.inc()
+        started_at = time.perf_counter()
+        try:
+            with self.__connect() as mysql_connector:
+                plan_started_at = time.perf_counter()
+                (history_id, message_ids) = self.__plan_fetch(mysql_connector)
+                self.__record_timing('plan', plan_started_at)
+                threads = [
+                    threading.Thread(target=self.__run_stage, args=(self.__fetch, message_ids), name='sync-fetch'),
+                    threading.Thread(target=self.__run_stage, args=(self.__classify,), name='sync-classify'),
+                ]
+                for thread in threads:
+                    thread.start()
+                self.__run_stage(self.__persist, mysql_connector)
+                for thread in threads:
+                    thread.join()
+                if self.errors:
+                    raise self.errors[0]
+                # only advance the cursor once every email is stored, so a failed run is retried from the same point
+                failed_message_ids = self.email_retriever.failed_message_ids
+                if failed_message_ids:
+                    print(f'{len(failed_message_ids)} emails could not be retrieved, keeping the sync cursor to retry them')
+                else:
+                    mysql_connector.set_history_id(history_id)
+        except BaseException as error:
+            self.progress.finish(error)
+            SYNC_SECONDS.labels('error').observe(time.perf_counter() - started_at)
+            raise
+        finally:
+            SYNCS_IN_FLIGHT.dec()
+            # items left behind by a stopped pipeline are no longer waiting
+            for remaining in (self.fetched_queue, self.classified_queue):
+                self.__queue_depth(remaining).dec(remaining.qsize())
+        self.progress.finish()
+        elapsed = time.perf_counter() - started_at
+        SYNC_SECONDS.labels('ok').observe(elapsed)
+        print(f'finished syncing emails in {elapsed:.1f}s')
+
+    def __plan_fetch(self, mysql_connector: MySqlConnector) -> tuple[str, Optional[set[str]]]:
+        """
+        Decides what to retrieve: the emails added since the last sync plus up to unclassified_retry_limit stored
+        emails still without a priority (other than those a pending backfill covers), or the whole unread inbox if
+        there is no usable sync cursor.
+        Emails deleted from the mailbox since the last sync are removed from the database.
+        :return: (historyId to record once the emails are stored, ids of the emails to retrieve or None for all)
+        """
+        history_id = mysql_connector.get_history_id()
+        if history_id is not None:
+            try:
+                delta = self.email_retriever.retrieve_history(history_id)
+                mysql_connector.delete_emails(delta.deleted_ids)
+                pending_backfill = PendingBackfill(self.progress.redis_client, mysql_connector.schema_name)
+                self.unclassified_ids = (mysql_connector.get_gmail_ids_without_priority(self.unclassified_retry_limit)
+                                         - delta.added_ids - pending_backfill.get_gmail_ids())
+                print(f'retrieving {len(delta.added_ids)} new emails and {len(self.unclassified_ids)} unclassified ones')
+                return delta.history_id, delta.added_ids | self.unclassified_ids
+            except HistoryExpiredError:
+                print(f'History {history_id} expired. Performing full resync...')
+
+        history_id = self.email_retriever.retrieve_history_id()
+        return history_id, None
+
+    def __fetch(self, message_ids: Optional[set[str]]) -> None:
+        with self.__connect() as mysql_connector:
+            # only download the bodies of emails that still need classification
+            select_ids_needing_body = mysql_connector.get_gmail_ids_needing_priority
+            if message_ids is None:
+                emails = self.email_retriever.retrieve_emails(select_ids_needing_body)
+            else:
+                emails = self.email_retriever.retrieve_emails_by_id(message_ids, select_ids_needing_body)
+            started_at = time.perf_counter()
+            new_emails = 0
+            for email in emails:
+                self.__record_timing('fetch', started_at)
+                if not self.__put(self.fetched_queue, email):
+                    return
+                self.progress.increment('fetched', 1)
+                if email.gmail_id not in self.unclassified_ids:
+                    new_emails += 1
+                started_at = time.perf_counter()
+            self.progress.increment('new', new_emails)
+        self.__put(self.fetched_queue, DONE)
+
+    def __classify(self) -> None:
+        with self.__connect() as mysql_connector:
+            classifier = EmailClassifier(self.secrets, mysql_connector, self.llm_quota)
+            done = False
+            while not done:
+                batch: list[Email] = []
+                while len(batch) < self.micro_batch_size:
+                    # don't wait for a full batch while emails trickle in from Gmail
+                    item = self.__get(self.fetched_queue, block=not batch)
+                    if item is None:
+                        break
+                    if item is DONE:
+                        done = True
+                        break
+                    batch.append(item)
+                if self.stop_event.is_set():
+                    return
+                if batch:
+                    started_at = time.perf_counter()
+                    classifier.classify(batch)
+                    self.__record_timing('classify', started_at)
+                    self.progress.increment('classified', len(batch))
+                    if not self.__put(self.classified_queue, batch):
+                        return
+            classifier.report()
+        self.__put(self.classified_queue, DONE)
+
+    def __persist(self, mysql_connector: MySqlConnector) -> None:
+        while True:
+            batch = self.__get(self.classified_queue)
+            if batch is None:
+                return
+            if batch is DONE:
+                return
+            started_at = time.perf_counter()
+            mysql_connector.sync_emails_to_db(batch)
+            self.__record_timing('persist', started_at)
+            self.progress.increment('persisted', len(batch))
+
+    def __record_timing(self, stage: str, started_at: float) -> None:
+        elapsed = time.perf_counter() - started_at
+        SYNC_STAGE_SECONDS.labels(stage).observe(elapsed)
+        if self.stage_timings is not None:
+            self.stage_timings.setdefault(stage, []).append(elapsed)
+
+    def __run_stage(self, stage, *args) -> None:
+        try:
+            stage(*args)
+        except BaseException as error:
+            self.errors.append(error)
+            # unblock the other stages so the pipeline shuts down instead of waiting forever
+            self.stop_event.set()
+
+    def __put(self, target: queue.Queue, item: Any) -> bool:
+        """
+        :return: False if the pipeline was stopped before the item could be queued
+        """
+        while not self.stop_event.is_set():
+            try:
+                target.put(item, timeout=0.1)
+                self.__queue_depth(target).inc()
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def __get(self, source: queue.Queue, block: bool = True) -> Optional[Any]:
+        """
+        :return: the next item, or None if the pipeline was stopped (or, when not blocking, the queue is empty)
+        """
+        while not self.stop_event.is_set():
+            try:
+                item = source.get(timeout=0.1) if block else source.get_nowait()
+                self.__queue_depth(source).dec()
+                return item
+            except queue.Empty:
+                if not block:
+                    return None
+        return None
+
+    def __queue_depth(self, target: queue.Queue):
+        return PIPELINE_QUEUE_DEPTH.labels('fetched' if target is self.fetched_queue else 'classified')
+
+    def __connect(self) -> MySqlConnector:
+        return MySqlConnector(self.secrets.mysql_password, self.username, self.schema_name, self.response_cache)
+
+
+class EmailClassifier:
+    """
+    Assigns priorities to micro-batches of emails: locally when the PreClassifier is confident, otherwise with the
+    EmailAnalyzer. Only emails that are new or stored without a priority are evaluated.
+    """
+    def __init__(self, secrets: Secrets, mysql_connector: MySqlConnector, llm_quota: Optional[QuotaBudget] = None):
+        self.call_chatgpt_api = secrets.call_chatgpt_api
+        self.mysql_connector = mysql_connector
+        self.pre_classifier = PreClassifier(mysql_connector.get_sender_priority_counts())
+        self.email_analyzer = EmailAnalyzer(secrets.openai_base_url, secrets.openai_max_concurrency,
+                                            secrets.openai_requests_per_second, cache=ClassificationCache(mysql_connector),
+                                            emails_per_request=secrets.openai_emails_per_request,
+                                            max_body_tokens=secrets.openai_max_body_tokens, token_budget=llm_quota) \
+            if self.call_chatgpt_api else None
+        self.sent_to_llm = 0
+
+    def classify(self, emails: list[Email]) -> None:
+        gmail_ids_needing_priority = self.mysql_connector.get_gmail_ids_needing_priority([email.gmail_id for email in emails])
+        emails_needing_priority = [email for email in emails if email.gmail_id in gmail_ids_needing_priority]
+        # TODO: remove this logic here. It's just for testing.
+        for email in emails_needing_priority:
+            email.priority = random.choice([Priority.LOW, Priority.MEDIUM, Priority.HIGH])
+        if not self.call_chatgpt_api:
+            return
+
+        # classify what can be classified locally, and only send the ambiguous emails to the LLM
+        emails_needing_analysis: list[Email] = []
+        for email in emails_needing_priority:
+            pre_classification = self.pre_classifier.classify(email)
+            if pre_classification is not None:
+                email.priority = pre_classification.priority
+            else:
+                emails_needing_analysis.append(email)
+        self.sent_to_llm += len(emails_needing_analysis)
+
+        priorities = self.email_analyzer.determine_email_priorities(emails_needing_analysis)
+        for email in emails_needing_analysis:
+            # emails that could not be analyzed keep a NULL priority, which the next incremental syncs fetch again
+            email.priority = priorities.get(email.gmail_id)
+
+    def report(self) -> None:
+        if self.call_chatgpt_api:
+            pre_classified = self.pre_classifier.hits
+            print(f'pre-classified {pre_classified} of {pre_classified + self.pre_classifier.misses} emails '
+                  f'(hit rate {self.pre_classifier.hit_rate:.0%}), {self.sent_to_llm} sent to the LLM')
+        print('finished evaluating email priorities')
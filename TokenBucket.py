@@ -0,0 +1,37 @@
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket rate limiter.
+    Tokens refill continuously at `rate` per second, up to `capacity` (the largest burst allowed).
+    """
+    def __init__(self, rate: float, capacity: float):
+        if rate <= 0 or capacity <= 0:
+            raise ValueError('rate and capacity must be positive')
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens: float = 1) -> None:
+        """
+        Blocks until `tokens` tokens are available, then takes them.
+        """
+        if tokens > self.capacity:
+            raise ValueError(f'cannot acquire {tokens} tokens from a bucket with capacity {self.capacity}')
+        while True:
+            with self.lock:
+                self.__refill()
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait_seconds = (tokens - self.tokens) / self.rate
+            time.sleep(wait_seconds)
+
+    def __refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
@@ -0,0 +1,71 @@
+import argparse
+import threading
+import time
+from prometheus_client import start_http_server
+from redis import Redis
+from JobQueue import Job, JobQueue
+from Metrics import InstrumentedRedis
+from QuotaBudget import QuotaBudget
+from ResponseCache import ResponseCache
+from Secrets import Secrets
+from SyncPipeline import SyncPipeline, SyncProgress
+
+
+class Worker:
+    """
+    Runs inbox sync jobs from the JobQueue. Start as many worker processes as needed:
+        python Worker.py
+    """
+    def __init__(self, secrets: Secrets, redis_client: Redis, job_queue: JobQueue, poll_interval_seconds: float = 1):
+        self.secrets = secrets
+        self.redis_client = redis_client
+        self.job_queue = job_queue
+        self.response_cache = ResponseCache(redis_client)
+        self.gmail_quota = QuotaBudget.gmail(redis_client, secrets.gmail_quota_units_per_second)
+        self.llm_quota = QuotaBudget.llm(redis_client, secrets.llm_tokens_per_minute)
+        self.poll_interval_seconds = poll_interval_seconds
+
+    def run_forever(self) -> None:
+        print('Waiting for sync jobs...')
+        while True:
+            job = self.job_queue.claim()
+            if job is None:
+                time.sleep(self.poll_interval_seconds)
+                continue
+            self.run_job(job)
+
+    def run_job(self, job: Job) -> None:
+        print(f'Running sync job {job.job_id} (attempt {job.attempts})')
+        finished = threading.Event()
+        heartbeat = threading.Thread(target=self.__keep_job_invisible, args=(job, finished), daemon=True)
+        heartbeat.start()
+        try:
+            session = self.redis_client.hgetall(f'session:{job.session_id}')
+            if not session.get('credentials'):
+                print(f'Session of sync job {job.job_id} expired. Dropping it.')
+            else:
+                progress = SyncProgress(self.redis_client, job.schema_name)
+                SyncPipeline(self.secrets, session['credentials'], session.get('username'), job.schema_name,
+                             self.response_cache, progress, gmail_quota=self.gmail_quota, llm_quota=self.llm_quota).run()
+        except Exception as error:
+            print(f'Sync job {job.job_id} failed: {error}')
+            finished.set()
+            self.job_queue.fail(job, error)
+            return
+        finished.set()
+        self.job_queue.acknowledge(job)
+
+    def __keep_job_invisible(self, job: Job, finished: threading.Event) -> None:
+        while not finished.wait(self.job_queue.visibility_timeout_seconds / 3):
+            self.job_queue.extend(job)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run inbox sync jobs queued by the web app.')
+    parser.add_argument('--poll-interval', type=float, default=1, help='seconds to wait when the queue is empty')
+    parser.add_argument('--metrics-port', type=int, help='serve this worker\'s Prometheus metrics on this port')
+    args = parser.parse_args()
+    if args.metrics_port is not None:
+        start_http_server(args.metrics_port)
+    redis_client = InstrumentedRedis(host='localhost', port=6379, db=0, decode_responses=True)
+    Worker(Secrets.from_env(), redis_client, JobQueue(redis_client), args.poll_interval).run_forever()
@@ -1,69 +1,84 @@
+import asyncio
+import json
 import os
-import random
-from dns.tsig import BadSignature
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from datetime import datetime, timedelta
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, PlainTextResponse
+from fastapi.encoders import jsonable_encoder
 
-from Email import Email, Priority
-from EmailAnalyzer import EmailAnalyzer
+from Email import Priority
 from EmailRetriever import EmailRetriever
-from MySqlConnector import MySqlConnector
+from JobQueue import JobQueue
+from Metrics import JOB_QUEUE_DEPTH, RESPONSE_CACHE_LOOKUPS, InstrumentedAsyncRedis, InstrumentedRedis, SamplingProfiler, render_metrics
+from MySqlConnector import AsyncMySqlConnector, MySqlConnector
+from ResponseCache import AsyncResponseCache, ResponseCache
 from Secrets import Secrets
-from fastapi import FastAPI, Request, Response, BackgroundTasks, HTTPException
+from Scheduler import AsyncSyncSchedule
+from SyncPipeline import SyncProgress
+from fastapi import FastAPI, Request, Response, HTTPException, Query, Depends
 from fastapi.responses import RedirectResponse
 from google_auth_oauthlib.flow import Flow
-from redis import Redis
-from itsdangerous import Signer
+from itsdangerous import Signer, BadSignature
 import uuid
 import uvicorn
+from typing import Optional
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    # asyncio connections are bound to the event loop that opened them
+    await async_redis_client.aclose()
+    await AsyncMySqlConnector.close_pool()
+
+
+app = FastAPI(lifespan=lifespan)
 secrets = Secrets.from_env()
 secrets_file = secrets.gmail_api_client_secret_filename
 SCOPES = ["https://www.googleapis.com/auth/gmail.readonly"]
 SIGNING_KEY = 'READ_THIS_FROM_DOTENV'
 signer = Signer(SIGNING_KEY)
 SESSION_COOKIE = 'session_id'
-redis_client = Redis(host='localhost', port=6379, db=0, decode_responses=True)
+redis_client = InstrumentedRedis(host='localhost', port=6379, db=0, decode_responses=True)
+response_cache = ResponseCache(redis_client)
+sync_queue = JobQueue(redis_client)
+# the request path (session lookup, /api/priorities and /emails) is async end to end so that it never blocks the
+# threadpool; the less frequent routes keep their blocking clients
+async_redis_client = InstrumentedAsyncRedis(host='localhost', port=6379, db=0, decode_responses=True)
+async_response_cache = AsyncResponseCache(async_redis_client)
+sync_schedule = AsyncSyncSchedule(async_redis_client)
 app.mount('/public', StaticFiles(directory='public'), name='public')
 templates = Jinja2Templates(directory='./public')
 
 
-def run(request: Request) -> None:
+@app.middleware('http')
+async def profile_request(request: Request, call_next):
     """
-    1. Retrieve emails
-    2. Analyze emails if necessary
-    3. Update database with any new emails and/or priorities
+    When profiling is enabled (ENABLE_PROFILING=true), adding ?profile=1 to any request returns a sampled profile of
+    it in collapsed-stack format instead of its response.
     """
-    mysql_password = secrets.mysql_password
-    call_chatgpt_api = secrets.call_chatgpt_api
-    credentials_json = retrieve_credentials(request)
-    (username, emails) = fetch_emails(credentials_json)
-    # TODO: remove this logic here. It's just for testing.
-    for email in emails:
-        email.priority = random.choice([Priority.LOW, Priority.MEDIUM, Priority.HIGH])
-    with MySqlConnector(mysql_password, username) as mysql_connector:
-        if call_chatgpt_api:
-            evaluate_email_priorities_if_necessary(mysql_connector, emails)
-        mysql_connector.sync_emails_to_db(emails)
-
-
-def fetch_emails(credentials_json: str) -> tuple[str, list[Email]]:
-    email_retriever = EmailRetriever(credentials_json, SCOPES)
-    username = email_retriever.retrieve_username()
-    emails = email_retriever.retrieve_emails()
-    print('finished retrieving emails')
-    return username, emails
-
-
-def evaluate_email_priorities_if_necessary(mysql_connector: MySqlConnector, emails: list[Email]) -> None:
-    email_analyzer = EmailAnalyzer()
-    gmail_ids_without_priority = mysql_connector.get_gmail_ids_without_priority()
-    emails_needing_priority = (email for email in emails if email.gmail_id in gmail_ids_without_priority)
-    for email in emails_needing_priority:
-        email.priority = email_analyzer.determine_email_priority(email)
-    print('finished evaluating email priorities')
+    if not secrets.enable_profiling or request.query_params.get('profile') != '1':
+        return await call_next(request)
+    with SamplingProfiler() as profiler:
+        await call_next(request)
+    return PlainTextResponse(profiler.render())
+
+
+@dataclass()
+class SessionContext:
+    session_id: str
+    credentials: str
+    # Gmail username and MySql schema name, resolved once per session (see get_user_session)
+    username: Optional[str]
+    schema_name: Optional[str]
+    has_pulled_emails_recently: bool
+
+    @property
+    def hash_name(self) -> str:
+        return f'session:{self.session_id}'
 
 
 def create_session(response: Response) -> None:
@@ -73,76 +88,148 @@ def create_session(response: Response) -> None:
     response.set_cookie(key=SESSION_COOKIE, value=signed_session_id, httponly=True)
 
 
-def set_credentials(request: Request, credentials_json: str) -> None:
+def get_session_id(request: Request) -> str:
     signed_session_id = request.cookies.get(SESSION_COOKIE)
     if not signed_session_id:
         raise HTTPException(status_code=401, detail="Not authenticated")
     try:
-        session_id = signer.unsign(signed_session_id).decode()
+        return signer.unsign(signed_session_id).decode()
     except BadSignature:
         raise HTTPException(status_code=401, detail='Invalid session cookie')
 
-    hash_name = f'session:{session_id}'
-    redis_client.hset(hash_name, mapping={'credentials': credentials_json})
-    redis_client.expire(hash_name, timedelta(hours=1))
-
 
-def retrieve_credentials(request: Request) -> str:
-    signed_session_id = request.cookies.get(SESSION_COOKIE)
-    if not signed_session_id:
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    try:
-        session_id = signer.unsign(signed_session_id).decode()
-    except BadSignature:
-        raise HTTPException(status_code=401, detail='Invalid session cookie')
-    credentials = redis_client.hget(f'session:{session_id}', 'credentials')
-    if not credentials:
+async def get_session(request: Request) -> SessionContext:
+    """
+    FastAPI dependency that unsigns the session cookie and loads every session field with a single Redis call.
+    """
+    session_id = get_session_id(request)
+    fields = await async_redis_client.hgetall(f'session:{session_id}')
+    if not fields.get('credentials'):
         raise HTTPException(status_code=401, detail='Session expired or invalid')
-    return credentials
+    return SessionContext(
+        session_id=session_id,
+        credentials=fields['credentials'],
+        username=fields.get('username'),
+        schema_name=fields.get('schema_name'),
+        has_pulled_emails_recently='has_pulled_emails_recently' in fields,
+    )
 
 
-def prevent_pulling_emails(request: Request) -> None:
-    signed_session_id = request.cookies.get(SESSION_COOKIE)
-    if not signed_session_id:
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    try:
-        session_id = signer.unsign(signed_session_id).decode()
-    except BadSignature:
-        raise HTTPException(status_code=401, detail='Invalid session cookie')
+async def get_user_session(session: SessionContext = Depends(get_session)) -> SessionContext:
+    """
+    FastAPI dependency returning the session with its username and schema name resolved.
+    Gmail is only asked for the username the first time; the result is cached in the session.
+    """
+    if session.username is None:
+        # the Gmail client is blocking, so keep its one call per session off the event loop
+        session.username = await asyncio.to_thread(EmailRetriever(session.credentials, SCOPES).retrieve_username)
+        session.schema_name = MySqlConnector.get_schema_name(session.username)
+        await async_redis_client.hset(session.hash_name, mapping={'username': session.username,
+                                                                  'schema_name': session.schema_name})
+    return session
 
-    hash_name = f'session:{session_id}'
-    redis_client.hset(hash_name, mapping={'has_pulled_emails_recently': 'true'})
-    redis_client.hexpire(hash_name, 5 * 60, 'has_pulled_emails_recently')
 
+def set_credentials(request: Request, credentials_json: str) -> None:
+    hash_name = f'session:{get_session_id(request)}'
+    with redis_client.pipeline() as pipeline:
+        pipeline.hset(hash_name, mapping={'credentials': credentials_json})
+        # the new credentials may belong to a different account
+        pipeline.hdel(hash_name, 'username', 'schema_name')
+        pipeline.expire(hash_name, timedelta(hours=1))
+        pipeline.execute()
 
-def get_should_pull_emails(request: Request) -> bool:
-    signed_session_id = request.cookies.get(SESSION_COOKIE)
-    if not signed_session_id:
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    try:
-        session_id = signer.unsign(signed_session_id).decode()
-    except BadSignature:
-        raise HTTPException(status_code=401, detail='Invalid session cookie')
 
-    existing_value = redis_client.hget(f'session:{session_id}', 'has_pulled_emails_recently')
-    return existing_value is None
+async def prevent_pulling_emails(session: SessionContext) -> None:
+    async with async_redis_client.pipeline() as pipeline:
+        pipeline.hset(session.hash_name, mapping={'has_pulled_emails_recently': 'true'})
+        pipeline.hexpire(session.hash_name, 5 * 60, 'has_pulled_emails_recently')
+        await pipeline.execute()
 
 
 @app.get('/api/priorities/{priority}')
-def get_emails_with_priority(request: Request, priority: str):
+async def get_emails_with_priority(priority: str, page_size: int = Query(50, ge=1, le=500), cursor: Optional[str] = None,
+                             session: SessionContext = Depends(get_user_session)):
+    """
+    Returns one page of emails with the given priority, newest first.
+    Pass the returned next_cursor as ?cursor= to get the following page. It is null on the last page.
+    Responses are served from the ResponseCache until the user's emails change.
+    """
     if not priority in {'low', 'medium', 'high'}:
         raise HTTPException(status_code=400, detail='Invalid priority')
+    (cached_response, generation) = await async_response_cache.get(session.schema_name, priority, page_size, cursor)
+    if cached_response is not None:
+        return Response(content=cached_response, media_type='application/json')
+
+    mysql_password = secrets.mysql_password
+    async with AsyncMySqlConnector(mysql_password, session.username, session.schema_name) as mysql_connector:
+        try:
+            (emails, next_cursor) = await mysql_connector.retrieve_emails_with_priority(Priority(priority), page_size,
+                                                                                        cursor)
+        except ValueError:
+            raise HTTPException(status_code=400, detail='Invalid cursor')
+    response_json = json.dumps(jsonable_encoder({'emails': emails, 'next_cursor': next_cursor}))
+    await async_response_cache.set(session.schema_name, priority, page_size, cursor, generation, response_json)
+    return Response(content=response_json, media_type='application/json')
+
+
+@app.get('/api/search')
+async def search_emails(q: Optional[str] = Query(None, max_length=200), priority: Optional[str] = None,
+                        sender: Optional[str] = Query(None, max_length=200), sent_after: Optional[datetime] = None,
+                        sent_before: Optional[datetime] = None, page_size: int = Query(50, ge=1, le=500),
+                        cursor: Optional[str] = None, session: SessionContext = Depends(get_user_session)):
+    """
+    Returns one page of the emails matching every given filter, newest first:
+    - q: words that must all appear (as word prefixes) in the subject or sender
+    - priority: 'low', 'medium' or 'high'
+    - sender: prefix of the sender
+    - sent_after (inclusive) and sent_before (exclusive): ISO 8601 date/times
+    Pass the returned next_cursor as ?cursor= (with the same filters) to get the following page.
+    """
+    if priority is not None and priority not in {'low', 'medium', 'high'}:
+        raise HTTPException(status_code=400, detail='Invalid priority')
     mysql_password = secrets.mysql_password
-    credentials_json = retrieve_credentials(request)
-    email_retriever = EmailRetriever(credentials_json, SCOPES)
-    username = email_retriever.retrieve_username()
-    with MySqlConnector(mysql_password, username) as mysql_connector:
-        if priority == Priority.LOW:
-            return mysql_connector.retrieve_emails_with_priority(Priority.LOW)
-        elif priority == Priority.MEDIUM:
-            return mysql_connector.retrieve_emails_with_priority(Priority.MEDIUM)
-        else:
-            return mysql_connector.retrieve_emails_with_priority(Priority.HIGH)
+    async with AsyncMySqlConnector(mysql_password, session.username, session.schema_name) as mysql_connector:
+        try:
+            (emails, next_cursor) = await mysql_connector.search_emails(
+                q, Priority(priority) if priority else None, sender, sent_after, sent_before, page_size, cursor)
+        except ValueError as error:
+            raise HTTPException(status_code=400, detail=str(error))
+    return {'emails': emails, 'next_cursor': next_cursor}
+
+
+@app.get('/api/stats')
+async def get_stats(top_senders: int = Query(10, ge=1, le=100), days: int = Query(30, ge=1, le=366),
+                    session: SessionContext = Depends(get_user_session)):
+    """
+    Inbox summary: email counts by priority, the top_senders senders of the most high-priority emails, and the number
+    of emails received on each of the last days. Read from aggregate tables kept up to date by every sync.
+    """
+    mysql_password = secrets.mysql_password
+    async with AsyncMySqlConnector(mysql_password, session.username, session.schema_name) as mysql_connector:
+        return await mysql_connector.get_stats(top_senders, days)
+
+
+@app.get('/api/sync/status')
+def get_sync_status(session: SessionContext = Depends(get_user_session)):
+    """
+    Progress of the user's current (or last) sync: state plus fetched, classified and persisted counts.
+    """
+    return SyncProgress.get(redis_client, session.schema_name)
+
+
+@app.get('/metrics')
+def get_metrics():
+    """
+    Prometheus metrics of this process: external call counts and latencies, sync stage timings and queue depths,
+    plus the response cache's hits and misses.
+    """
+    JOB_QUEUE_DEPTH.set(sync_queue.get_depth())
+    cache_stats = response_cache.get_stats()
+    RESPONSE_CACHE_LOOKUPS.labels('hit').set(cache_stats['hits'])
+    RESPONSE_CACHE_LOOKUPS.labels('miss').set(cache_stats['misses'])
+    (body, content_type) = render_metrics()
+    return Response(content=body, media_type=content_type)
+
 
 @app.get('/callback')
 def callback(request: Request):
@@ -165,21 +252,20 @@ def login():
 
 
 @app.get('/emails')
-def emails(request: Request, background_tasks: BackgroundTasks):
+async def emails(request: Request):
     try:
-        retrieve_credentials(request)
+        session = await get_user_session(await get_session(request))
     except HTTPException:
         return RedirectResponse('http://localhost:8000/')
 
-    should_pull_emails = get_should_pull_emails(request)
-    if should_pull_emails:
-        background_tasks.add_task(run, request) # start expensive run(request) method in background. Let endpoint resolve without waiting on that task.
-        prevent_pulling_emails(request)
+    # the inbox is refreshed in the background while the session lasts (see Scheduler.py and Worker.py).
+    # A visit only brings the next sync forward if the inbox has not been pulled recently.
+    await sync_schedule.activate(session.session_id, session.schema_name, sync_now=not session.has_pulled_emails_recently)
+    if not session.has_pulled_emails_recently:
+        await prevent_pulling_emails(session)
         print('Pulling new emails')
     else:
         print('New emails will not be pulled.')
-    # username = email_retriever.retrieve_username()
-    # emails = email_retriever.retrieve_emails()
     return templates.TemplateResponse(request, 'index.html')
 
 
@@ -209,5 +295,6 @@ if __name__ == '__main__':
     2. Navigate to http://localhost:8000/login. This will start the authentication flow
     
     The frontend will bridge this gap, but if you're testing just using the backend you must visit the two endpoints separately.
+    Emails are only synced while the scheduler (python Scheduler.py) and at least one worker (python Worker.py) run.
     """
     uvicorn.run(app)